@@ -0,0 +1,135 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WRITER_THREADS = 4
+WRITER_QUEUE_SIZE = 16
+JPEG_QUALITY = 95
+PNG_COMPRESSION = 1
+FSYNC = False
+LINK_MODES = ('hardlink', 'reflink', 'symlink', 'copy')  # tried in this order by `link_file`
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+def reflink(src, dst):
+    """Copy-on-write clone of `src`, raises OSError where the filesystem does not support it."""
+    if fcntl is None:
+        raise OSError("reflinks need fcntl")
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+    if not cloned:
+        os.remove(dst)
+        raise OSError(f"Could not reflink {src}")
+    shutil.copystat(src, dst)
+
+
+class AsyncWriter:
+    """Encodes and writes files on a thread pool while the caller keeps computing.
+
+    At most `queue_size` jobs are pending, `submit` blocks once the queue is full.
+    Failed jobs are collected and raised from `close`, which waits for every
+    pending write. Arrays handed to the writer must not be modified afterwards.
+    """
+
+    def __init__(self, threads=WRITER_THREADS, queue_size=WRITER_QUEUE_SIZE,
+                 jpeg_quality=JPEG_QUALITY, png_compression=PNG_COMPRESSION, fsync=FSYNC, link_modes=LINK_MODES):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+        self.fsync = fsync
+        self.link_modes = link_modes
+        self.lock = threading.Lock()
+        self.errors = []
+        self.completed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the original exception behind write errors
+            self.executor.shutdown(wait=True)
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            self.executor.submit(self.run, fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def run(self, fn, *args):
+        try:
+            fn(*args)
+            with self.lock:
+                self.completed += 1
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise RuntimeError(f"{len(self.errors)} of {len(self.errors) + self.completed} writes failed, "
+                               f"first error: {self.errors[0]}") from self.errors[0]
+
+    def write_bytes(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def write_image(self, path, img):
+        ext = os.path.splitext(path)[1].lower()
+        params = []
+        if ext in ('.jpg', '.jpeg'):
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        elif ext == '.png':
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        ok, buf = cv2.imencode(ext, img, params)
+        if not ok:
+            raise IOError(f"Could not encode {path}")
+        self.write_bytes(path, buf)
+
+    def copy_file(self, src, dst):
+        shutil.copy2(src, dst)
+        if self.fsync:
+            fd = os.open(dst, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def link_file(self, src, dst):
+        """Makes `src` available at `dst` without copying data where the filesystem allows it."""
+        for mode in self.link_modes:
+            try:
+                if mode == 'hardlink':
+                    os.link(src, dst)
+                elif mode == 'reflink':
+                    reflink(src, dst)
+                elif mode == 'symlink':
+                    os.symlink(os.path.abspath(src), dst)
+                else:
+                    self.copy_file(src, dst)
+                return mode
+            except OSError:
+                if mode == self.link_modes[-1]:
+                    raise
@@ -0,0 +1,221 @@
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+from create_mixed_dataset import CANVAS_SHAPE, compose_mix, render_shape, sprite_scale
+from placement import PlacementEngine
+from polygons import mask_to_polygons
+from sprite_cache import SPRITE_BASE_SCALE
+from stream_inference import summarize as latency_stats
+from tflite_detector import Detector, filter_detections, latest_model_path, letterbox_params, scale_boxes
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+UPDATE_BASELINE = False  # store this run as the new baseline
+REGRESSION_TOLERANCE = 0.10  # a p50 more than this much slower than the baseline is reported as a regression
+SEED = 1
+SPRITE_COUNT = 40
+TRAIN_SPRITE_COUNT = 1200  # about the size of the train split, a train mix pastes a fifth of them
+CLASS_COUNT = 47
+WARMUP = 2
+REPEATS = {"compose_render": 50, "compose_full": 5, "compose_train": 30, "placement": 200, "mask_to_polygons": 10,
+           "postprocess": 500, "tflite_invoke": 30}
+MODEL_PATH = None  # a .tflite file, None tries the latest training run
+
+
+class SyntheticSprites:
+    """In-memory stand-in for a SpriteCache with random elliptic subjects."""
+
+    def __init__(self, count, rng, base_scale=SPRITE_BASE_SCALE):
+        self.base_scale = base_scale
+        self.sprites = []
+        for i in range(count):
+            # the same subjects at any cache scale
+            h, w = (max(1, int(v * SPRITE_BASE_SCALE / base_scale)) for v in rng.integers(60, 180, 2))
+            sprite = np.zeros((h, w, 4), dtype=np.uint8)
+            sprite[..., :3] = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+            alpha = np.zeros((h, w), dtype=np.uint8)
+            cv2.ellipse(alpha, (w // 2, h // 2), (w // 2 - 1, h // 2 - 1), 0, 0, 360, 255, -1)
+            sprite[..., 3] = alpha
+            self.sprites.append((sprite, i % CLASS_COUNT, [int(h * base_scale), int(w * base_scale)]))
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def sprite(self, idx):
+        return self.sprites[idx]
+
+def synthetic_label_mask(rng, shape=CANVAS_SHAPE, subjects=12):
+    # class_id + 1 per pixel, like the masks of the segmentation tool and the compositor
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(subjects):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        axes = (int(rng.integers(40, 300)), int(rng.integers(40, 300)))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, int(rng.integers(1, CLASS_COUNT + 1)), -1)
+    return mask
+
+def synthetic_detections(rng, count=300):
+    # normalized x1 y1 x2 y2, conf and class like the NMS export, followed by 32 mask coefficients
+    xy = rng.random((count, 2)) * 0.9
+    wh = rng.random((count, 2)) * 0.1
+    det = np.concatenate([xy, xy + wh, rng.random((count, 1)), rng.integers(0, CLASS_COUNT, (count, 1)),
+                          rng.standard_normal((count, 32))], axis=1)
+    return det.astype(np.float32)[None]
+
+
+def time_runs(fn, repeats, warmup=WARMUP):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+def summarize(durations, items_per_run=1):
+    return dict(latency_stats(durations), throughput_per_s=round(items_per_run * len(durations) / sum(durations), 2))
+
+
+def bench_compose(sprites, canvas_shape, repeats, split="val"):
+    mix_idx = iter(range(10**9))
+    # a fresh stream per run like render_mix, the layouts differ but the workload is the same
+    return summarize(time_runs(lambda: compose_mix(split, sprites, np.random.default_rng([SEED, next(mix_idx)]),
+                                                   canvas_shape), repeats))
+
+def bench_placement(rng, repeats):
+    h, w = render_shape()
+    regions = []
+    for _ in range(40):
+        rh, rw = (int(v) for v in rng.integers(15, 60, 2))
+        region = np.zeros((rh, rw), dtype=np.uint8)
+        cv2.ellipse(region, (rw // 2, rh // 2), (rw // 2, rh // 2), 0, 0, 360, 1, -1)
+        regions.append(region.astype(bool))
+    place_rng = np.random.default_rng(SEED)
+
+    def fill_canvas():
+        engine = PlacementEngine(h, w)
+        for region in regions:
+            position = engine.find(region, place_rng)
+            if position is not None:
+                engine.place(*position, region)
+    return summarize(time_runs(fill_canvas, repeats), items_per_run=len(regions))
+
+def bench_mask_to_polygons(rng, repeats):
+    mask = synthetic_label_mask(rng)
+    values = [value for value in np.unique(mask) if value]
+
+    def convert():
+        for value in values:
+            mask_to_polygons(mask == value, tolerance=1.0)
+    return summarize(time_runs(convert, repeats))
+
+def bench_postprocess(rng, repeats, input_shape=(640, 640)):
+    img = rng.integers(0, 256, (*CANVAS_SHAPE, 3), dtype=np.uint8)
+    canvas = np.full((*input_shape, 3), 114, dtype=np.uint8)
+    det = synthetic_detections(rng)
+
+    def postprocess():
+        r, dw, dh, new_unpad = letterbox_params(img.shape[:2], input_shape)
+        top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+        canvas[top:top+new_unpad[1], left:left+new_unpad[0]] = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+        kept = filter_detections(det[0], 0.5)
+        scale_boxes(kept[:, :4], r, dw, dh, input_shape, img.shape[:2])
+    return summarize(time_runs(postprocess, repeats))
+
+def find_model(model_path=MODEL_PATH):
+    if model_path is not None:
+        return model_path if os.path.exists(model_path) else None
+    try:
+        path = latest_model_path()
+    except (FileNotFoundError, ValueError):
+        return None
+    return path if os.path.exists(path) else None
+
+def bench_tflite(model_path, rng, repeats):
+    detector = Detector(model_path)
+    detector.preprocess(rng.integers(0, 256, (*CANVAS_SHAPE, 3), dtype=np.uint8))
+    return summarize(time_runs(detector.invoke, repeats))
+
+
+BENCHMARKS = {
+    "compose_render": lambda rng, repeats: bench_compose(SyntheticSprites(SPRITE_COUNT, rng), render_shape(), repeats),
+    "compose_full": lambda rng, repeats: bench_compose(SyntheticSprites(SPRITE_COUNT, rng), CANVAS_SHAPE, repeats),
+    # what one dataloader worker of streaming_dataset.py can deliver per second
+    "compose_train": lambda rng, repeats: bench_compose(SyntheticSprites(TRAIN_SPRITE_COUNT, rng, base_scale=sprite_scale()),
+                                                        render_shape(), repeats, split="train"),
+    "placement": bench_placement,
+    "mask_to_polygons": bench_mask_to_polygons,
+    "postprocess": bench_postprocess,
+}
+
+def run_benchmark(name, repeats, model_path=None):
+    # runs in a fresh process, so the peak memory is that of this benchmark and the imports only
+    # one thread like the render workers, so numbers do not depend on the machine's core count
+    cv2.setNumThreads(1)
+    rng = np.random.default_rng(SEED)
+    if name == "tflite_invoke":
+        result = bench_tflite(model_path, rng, repeats)
+    else:
+        result = BENCHMARKS[name](rng, repeats)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def run_benchmarks(repeats=REPEATS, model_path=MODEL_PATH):
+    names = list(BENCHMARKS)
+    model_path = find_model(model_path)
+    if model_path is None:
+        print("Skipping tflite_invoke, no model file found", file=sys.stderr)
+    else:
+        names.append("tflite_invoke")
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                             max_tasks_per_child=1) as executor:
+        for name in names:
+            try:
+                results[name] = executor.submit(run_benchmark, name, repeats[name], model_path).result()
+            except ImportError as e:
+                print(f"Skipping {name}, {e}", file=sys.stderr)
+
+    return {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "opencv": cv2.__version__, "numpy": np.__version__},
+        "benchmarks": results,
+    }
+
+def compare_to_baseline(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    """p50 ratio against the baseline per benchmark, above 1 is slower."""
+    comparison = {}
+    for name, result in report["benchmarks"].items():
+        reference = baseline["benchmarks"].get(name)
+        if reference is None:
+            continue
+        ratio = result["p50_ms"] / reference["p50_ms"] if reference["p50_ms"] > 0 else float('inf')
+        comparison[name] = {"baseline_p50_ms": reference["p50_ms"], "p50_ms": result["p50_ms"],
+                            "ratio": round(ratio, 3), "regression": ratio > 1 + tolerance}
+    return comparison
+
+
+if __name__ == "__main__":
+    report = run_benchmarks()
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'r') as f:
+            report["comparison"] = compare_to_baseline(report, json.load(f))
+    if UPDATE_BASELINE or not os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump({"machine": report["machine"], "benchmarks": report["benchmarks"]}, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if any(entry["regression"] for entry in report.get("comparison", {}).values()):
+        sys.exit(1)
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def box_area(boxes):
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+def box_iou(a, b):
+    """IoU matrix between (n, 4) and (m, 4) arrays of x1, y1, x2, y2 boxes."""
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    union = box_area(a)[:, None] + box_area(b)[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+def nms(boxes, scores, iou_threshold):
+    """Indices of the boxes kept by greedy non-maximum suppression, best first."""
+    order = np.argsort(-scores, kind='stable')
+    iou = box_iou(boxes[order], boxes[order])
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(order[i])
+        suppressed |= iou[i] > iou_threshold
+    return np.array(keep, dtype=int)
+
+def batched_nms(boxes, scores, class_ids, iou_threshold):
+    # shift every class into its own region so boxes of different classes never overlap
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=int)
+    offsets = class_ids[:, None] * (boxes.max() + 1)
+    return nms(boxes + offsets, scores, iou_threshold)
+
+def weighted_box_fusion(boxes, scores, class_ids, iou_threshold):
+    """Merges overlapping boxes of the same class into score-weighted averages.
+
+    Returns (boxes, scores, class_ids) of the fused clusters, a cluster scores the
+    mean of its members.
+    """
+    fused_boxes, fused_scores, fused_classes = [], [], []
+    for class_id in np.unique(class_ids):
+        idx = np.flatnonzero(class_ids == class_id)
+        idx = idx[np.argsort(-scores[idx], kind='stable')]
+        cluster_boxes = np.zeros((0, 4))
+        weighted_sums = []
+        score_lists = []
+        for i in idx:
+            if len(cluster_boxes):
+                iou = box_iou(boxes[i:i+1], cluster_boxes)[0]
+                best = int(np.argmax(iou))
+                if iou[best] > iou_threshold:
+                    weighted_sums[best] += boxes[i] * scores[i]
+                    score_lists[best].append(scores[i])
+                    cluster_boxes[best] = weighted_sums[best] / sum(score_lists[best])
+                    continue
+            weighted_sums.append(boxes[i] * scores[i])
+            score_lists.append([scores[i]])
+            cluster_boxes = np.vstack((cluster_boxes, boxes[i]))
+        fused_boxes.append(cluster_boxes)
+        fused_scores.extend(np.mean(s) for s in score_lists)
+        fused_classes.extend([class_id] * len(score_lists))
+
+    if not fused_boxes:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=int)
+    return np.concatenate(fused_boxes), np.array(fused_scores), np.array(fused_classes, dtype=int)
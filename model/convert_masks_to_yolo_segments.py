@@ -1,14 +1,95 @@
+import json
 import os
-import cv2
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import tqdm
+import yaml
+
+from dataset_manifest import file_stat
+from mask_store import MaskStore, import_png_dir
+from polygons import format_polygon_label, mask_to_polygons
+from rle import rle_decode_crop
 
 DATASET_DIR = "dataset"
 MASKS_DIR = os.path.join(DATASET_DIR, "masks")
 OUTPUT_DIR = os.path.join(DATASET_DIR, "labels")
+YOLO_CONFIG = "data.yaml"
+MASK_STORE = "mixes"
+HASHES_FILE = ".mask_hashes.json"
+WORKERS = os.cpu_count() or 1
+POLYGON_TOLERANCE = 1.0  # max distance in pixels of the simplified polygon from the contour, 0 keeps every point
+
+
+def load_class_count(path=YOLO_CONFIG):
+    with open(path, 'r') as f:
+        return int(yaml.safe_load(f)['nc'])
 
-from ultralytics.data.converter import convert_segment_masks_to_yolo_seg
+def convert_records(records, label_path, class_count, tolerance):
+    lines = []
+    for record in records:
+        class_id = record['class_id']
+        if class_id >= class_count:
+            raise ValueError(f"The mask of {label_path} contains class {class_id}, but {YOLO_CONFIG} defines only {class_count}")
+        # only the bbox of every class is decoded, the offset places the polygons on the full mask
+        crop = rle_decode_crop(record, record['bbox'])
+        for polygon in mask_to_polygons(crop, record['bbox'][:2], record['size'], tolerance=tolerance):
+            lines.append(format_polygon_label(class_id, polygon))
 
-for dir_name in os.listdir(MASKS_DIR):
-    out_dir = os.path.join(OUTPUT_DIR, dir_name)
+    with open(label_path, 'w') as f:
+        f.write("\n".join(lines))
+
+def convert_store(store, prefix, out_dir, class_count, tolerance=POLYGON_TOLERANCE, workers=WORKERS):
+    """Writes a label for every mask named `prefix` + stem whose runs changed since the last call.
+
+    Label files this converter did not write, e.g. the per-instance polygons of
+    create_mixed_dataset.py, are never overwritten.
+    """
     os.makedirs(out_dir, exist_ok=True)
-    convert_segment_masks_to_yolo_seg(os.path.join(MASKS_DIR, dir_name), out_dir, classes=47)
+    hashes_path = os.path.join(out_dir, HASHES_FILE)
+
+    written = {}
+    up_to_date = False
+    if os.path.exists(hashes_path):
+        with open(hashes_path, 'r') as f:
+            record = json.load(f)
+        written = {name: entry for name, entry in record['masks'].items() if isinstance(entry, list)}
+        # labels made with another tolerance or class count have to be redone
+        up_to_date = record.get('tolerance') == tolerance and record.get('classes') == class_count
+
+    digests = {entry['name'][len(prefix):]: entry['digest'] for entry in store.entries(prefix)}
+    label_paths = {name: os.path.join(out_dir, name + '.txt') for name in digests}
+    owned = {}
+    pending = []
+    foreign = 0
+    for name, digest in digests.items():
+        if not os.path.exists(label_paths[name]):
+            pending.append(name)
+        elif name not in written or written[name][1] != file_stat(label_paths[name]):
+            foreign += 1  # written by someone else since
+        elif up_to_date and written[name][0] == digest:
+            owned[name] = written[name]
+        else:
+            pending.append(name)
+    if foreign:
+        print(f"Skipped {foreign} labels in {out_dir} that were not written from masks")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = executor.map(convert_records, [store.records(prefix + name) for name in pending],
+                            [label_paths[name] for name in pending], repeat(class_count), repeat(tolerance), chunksize=16)
+        list(tqdm.tqdm(jobs, total=len(pending), desc=prefix.rstrip('/')))
+
+    # the stat of every label written here tells them apart from labels written by other tools
+    owned.update({name: [digests[name], file_stat(label_paths[name])] for name in pending})
+    with open(hashes_path, 'w') as f:
+        json.dump({'tolerance': tolerance, 'classes': class_count, 'masks': owned}, f)
+
+
+if __name__ == '__main__':
+    class_count = load_class_count()
+    with MaskStore(MASK_STORE) as store:
+        # PNG masks are imported first, mixes rendered with MASK_FORMAT = "rle" are in the store already
+        if os.path.isdir(MASKS_DIR):
+            for dir_name in os.listdir(MASKS_DIR):
+                import_png_dir(store, os.path.join(MASKS_DIR, dir_name), prefix=dir_name + "/")
+        for split in sorted({entry['name'].split('/')[0] for entry in store.entries()}):
+            convert_store(store, split + "/", os.path.join(OUTPUT_DIR, split), class_count)
@@ -1,13 +1,31 @@
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache
+from itertools import repeat
 import os
+import zlib
 import numpy as np
 import cv2
 import tqdm
 
+from async_writer import AsyncWriter
+from dataset_manifest import GLUM_MASKS_DIR, open_manifest, query_images
+from mask_store import MaskStore, encode_label_mask, import_png_dir
+from placement import PlacementEngine
+from polygons import format_polygon_label, mask_to_polygons
+from sprite_cache import SPRITE_BASE_SCALE, SpriteCache, build_sprite_cache
+
 BASIC_DATASET_PATH = os.path.join(os.path.dirname(__file__), "basic_dataset")
 DATASET_PATH = os.path.join(os.path.dirname(__file__), "dataset")
 SPLITS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
 SEED = 1
+WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 16
+RESUME = True
+CANVAS_SHAPE = (4000, 2252)  # resolution of the table photos
+TRAIN_IMGSZ = 640  # imgsz used in model_training.py
+RENDER_MULTIPLE = 1.0  # compose with the long side at TRAIN_IMGSZ * RENDER_MULTIPLE, None for the full canvas
+WRITE_MASKS = False  # polygon labels are written directly, masks are only for inspection
+MASK_FORMAT = "rle"  # "rle" keeps mix masks in the "mixes" mask store, "png" writes full-size images
 
 def ensure_dirs():
     for split in SPLITS.keys():
@@ -19,116 +37,180 @@ def load_labels(path: str) -> str:
         label_line = f.readline().strip().split()
         class_id = int(label_line[0])
 
-@lru_cache(maxsize=128)
-def load_image(split, name):
+def build_sprites(split):
     src_dir  = os.path.join(BASIC_DATASET_PATH, "images", split)
-    mask_dir = os.path.join(BASIC_DATASET_PATH, "masks",  split)
-    return (cv2.imread(os.path.join(src_dir, name)),
-            cv2.imread(os.path.join(mask_dir, name[:-4] + ".png"), cv2.IMREAD_GRAYSCALE))
+    conn = open_manifest()
+    class_ids = {row['name']: row['class_id'] for row in query_images(conn, split=split, with_mask=True)}
+    conn.close()
+    with MaskStore("glum") as store:
+        import_png_dir(store, GLUM_MASKS_DIR)
+        build_sprite_cache(split, src_dir, store, class_ids, base_scale=sprite_scale())
+
+@lru_cache(maxsize=None)
+def load_sprites(split):
+    return SpriteCache(split)
+
+def rotate_sprite(sprite, angle):
+    # grow the canvas so the corners of the sprite are not cut off
+    h, w = sprite.shape[:2]
+    rot_mat = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    cos, sin = abs(rot_mat[0, 0]), abs(rot_mat[0, 1])
+    out_w = int(np.ceil(h * sin + w * cos))
+    out_h = int(np.ceil(h * cos + w * sin))
+    rot_mat[0, 2] += (out_w - w) / 2
+    rot_mat[1, 2] += (out_h - h) / 2
+    return cv2.warpAffine(sprite, rot_mat, (out_w, out_h), flags=cv2.INTER_LINEAR, borderValue=(0, 0, 0, 0))
+
+def mix_rng(split, mix_idx):
+    # every mix gets its own stream so the output does not depend on the worker count
+    return np.random.default_rng([SEED, zlib.crc32(split.encode()), mix_idx])
+
+def output_dirs(split):
+    return (os.path.join(DATASET_PATH, "images", split),
+            os.path.join(DATASET_PATH, "masks", split),
+            os.path.join(DATASET_PATH, "labels", split))
+
+def first_missing_mix(split, count):
+    # labels are written last, so an existing label file means the mix is complete
+    out_label_dir = output_dirs(split)[2]
+    for mix_idx in range(count):
+        if not os.path.exists(os.path.join(out_label_dir, f"mix_{mix_idx:04d}.txt")):
+            return mix_idx
+    return count
+
+def render_shape():
+    if RENDER_MULTIPLE is None:
+        return CANVAS_SHAPE
+    ratio = TRAIN_IMGSZ * RENDER_MULTIPLE / max(CANVAS_SHAPE)
+    return (round(CANVAS_SHAPE[0] * ratio), round(CANVAS_SHAPE[1] * ratio))
+
+def sprite_scale():
+    # cache the sprites at the largest size they are pasted at, so every paste only shrinks them a little
+    return SPRITE_BASE_SCALE * CANVAS_SHAPE[0] / render_shape()[0]
+
+def compose_mix(split, sprites, rng, canvas_shape=CANVAS_SHAPE, with_mask=False):
+    img = np.zeros((*canvas_shape, 3), dtype=np.uint8)
+    instance_map = np.zeros(canvas_shape, dtype=np.uint16)
+    placement = PlacementEngine(*instance_map.shape)
+    instances = []
+
+    # sprites keep the same size relative to the canvas at any resolution
+    canvas_scale = canvas_shape[0] / CANVAS_SHAPE[0]
+
+    perc = 0.2
+    if split != "train":
+        perc = 0.7
+
+    for sub_img_idx in rng.choice(len(sprites), int(perc*len(sprites)), replace=False):
+        for _ in range(3): # repeat three times to increase density of validation images
+            sprite, class_id, _ = sprites.sprite(sub_img_idx)
+
+            scale = SPRITE_BASE_SCALE + rng.random()
+            factor = sprites.base_scale / scale * canvas_scale
+            new_w = max(1, int(round(sprite.shape[1] * factor)))
+            new_h = max(1, int(round(sprite.shape[0] * factor)))
+            scaled_sprite = cv2.resize(sprite, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+            # Random rotation
+            angle = rng.uniform(0, 360)
+            rotated_sprite = rotate_sprite(scaled_sprite, angle)
+            rotated_img = rotated_sprite[..., :3]
+            region = rotated_sprite[..., 3] >= 128
+            new_h, new_w = region.shape
+
+            position = placement.find(region, rng)
+
+            # Skip this image if no valid placement exists
+            if position is None:
+                continue
+            y0, x0 = position
+            placement.place(y0, x0, region)
+
+            # Paste masked region
+            img[y0:y0+new_h, x0:x0+new_w][region] = rotated_img[region]
+            instance_map[y0:y0+new_h, x0:x0+new_w][region] = len(instances) + 1  # avoid 0 as background
+            instances.append((class_id, y0, x0, new_h, new_w))
+
+            if split == "train":
+                break
+
+    # Trace what is still visible of every instance once all later pastes are done
+    labels = []
+    for instance_idx, (class_id, y0, x0, h, w) in enumerate(instances):
+        visible = instance_map[y0:y0+h, x0:x0+w] == instance_idx + 1
+        for polygon in mask_to_polygons(visible, (x0, y0), instance_map.shape):
+            labels.append((class_id, polygon))
+
+    mask = None
+    if with_mask:
+        instance_classes = np.array([0] + [class_id + 1 for class_id, *_ in instances], dtype=np.uint8)
+        mask = instance_classes[instance_map]
+
+    return img, labels, mask
+
+def save_mix(writer, split, mix_idx, img, labels, mask):
+    out_img_dir, out_mask_dir, out_label_dir = output_dirs(split)
+    out_img_name = f"mix_{mix_idx:04d}.jpg"
+    out_mask_name = f"mix_{mix_idx:04d}.png"
+    out_label_name = f"mix_{mix_idx:04d}.txt"
+    writer.write_image(os.path.join(out_img_dir, out_img_name), img)
+    if mask is not None:
+        writer.write_image(os.path.join(out_mask_dir, out_mask_name), mask)
+    label_text = "\n".join(format_polygon_label(class_id, polygon) for class_id, polygon in labels)
+    writer.write_bytes(os.path.join(out_label_dir, out_label_name), label_text.encode())
+
+def render_mix(split, mix_idx, writer):
+    img, labels, mask = compose_mix(split, load_sprites(split), mix_rng(split, mix_idx), render_shape(), with_mask=WRITE_MASKS)
+    # Save outputs while the next mix is being composed
+    writer.submit(save_mix, writer, split, mix_idx, img, labels, mask if MASK_FORMAT == "png" else None)
+    if mask is not None and MASK_FORMAT == "rle":
+        # the records are small, the parent process puts them into the mask store
+        return f"{split}/mix_{mix_idx:04d}", mask.shape, encode_label_mask(mask)
+    return None
+
+def render_shard(split, mix_indices):
+    with AsyncWriter() as writer:
+        return [render_mix(split, mix_idx, writer) for mix_idx in mix_indices]
+
+def store_masks(results):
+    results = [result for result in results if result is not None]
+    if not results:
+        return
+    with MaskStore("mixes") as store:
+        for result in results:
+            store.put(*result)
+
+def init_worker():
+    # the pool already uses every core, keep opencv from spawning its own threads
+    cv2.setNumThreads(1)
 
 def transform_dataset():
     for split in SPLITS.keys():
         if split == "train":
             continue
-        src_dir  = os.path.join(BASIC_DATASET_PATH, "images", split)
-        out_img_dir = os.path.join(DATASET_PATH, "images", split)
-        out_mask_dir = os.path.join(DATASET_PATH, "masks", split)
-        out_label_dir = os.path.join(DATASET_PATH, "labels", split)
+        out_img_dir, out_mask_dir, out_label_dir = output_dirs(split)
         os.makedirs(out_img_dir, exist_ok=True)
-        os.makedirs(out_mask_dir, exist_ok=True)
         os.makedirs(out_label_dir, exist_ok=True)
-        avail_images = os.listdir(src_dir)
-        np.random.seed(SEED)
-
-
-        for mix_idx in tqdm.tqdm(range(len(avail_images))):
-            img = np.zeros((4000, 2252, 3), dtype=np.uint8)
-            mask = np.zeros((4000, 2252), dtype=np.uint8)
-            yolo_labels = []
-
-            perc = 0.2
-            if split != "train":
-                perc = 0.7
-
-            for sub_img_idx in tqdm.tqdm(np.random.choice(len(avail_images), int(perc*len(avail_images)), replace=False)):
-                for _ in range(3): # repeat three times to increase density of validation images
-                    sub_img, sub_img_mask = load_image(split, avail_images[sub_img_idx])
-                    class_id = sub_img_mask[sub_img_mask > 0][0] - 1
-
-                    scale = 5.5 + np.random.rand()
-                    new_w = int(sub_img.shape[1] / scale)
-                    new_h = int(sub_img.shape[0] / scale)
-                    scaled_img = cv2.resize(sub_img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-                    scaled_mask = cv2.resize(sub_img_mask, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
-                    
-                    # Random rotation
-                    angle = np.random.uniform(0, 360)
-                    center = (new_w // 2, new_h // 2)
-                    rot_mat = cv2.getRotationMatrix2D(center, angle, 1.0)
-                    rotated_img = cv2.warpAffine(scaled_img, rot_mat, (new_w, new_h), flags=cv2.INTER_LINEAR, borderValue=(0,0,0))
-                    rotated_mask = cv2.warpAffine(scaled_mask, rot_mat, (new_w, new_h), flags=cv2.INTER_NEAREST, borderValue=0)
-                    
-                    # Random placement with validation
-                    max_x = img.shape[1] - new_w
-                    max_y = img.shape[0] - new_h
-                    if max_x <= 0 or max_y <= 0:
-                        continue
-                    
-                    # Try up to 10 times to find a valid placement
-                    valid_placement = False
-                    for _ in range(10):
-                        x0 = np.random.randint(0, max_x)
-                        y0 = np.random.randint(0, max_y)
-                        
-                        # Check if placement covers enough clear background
-                        region = (rotated_mask > 0)
-                        if not np.any(region):
-                            continue
-                        
-                        # Get the background area that would be covered
-                        background_region = mask[y0:y0+new_h, x0:x0+new_w]
-                        clear_background_pixels = np.sum((background_region == 0) & region)
-                        total_region_pixels = np.sum(region)
-                        
-                        if total_region_pixels > 0 and clear_background_pixels / total_region_pixels >= 0.5:
-                            valid_placement = True
-                            break
-                    
-                    # Skip this image if no valid placement found
-                    if not valid_placement:
-                        continue
-                    
-                    # Paste masked region
-                    img[y0:y0+new_h, x0:x0+new_w][region] = rotated_img[region]
-                    mask[y0:y0+new_h, x0:x0+new_w][region] = class_id + 1  # avoid 0 as background
-                    
-                    # Bounding box for YOLO
-                    ys, xs = np.where(region)
-                    if len(xs) == 0 or len(ys) == 0:
-                        continue
-                    x_min = x0 + xs.min()
-                    x_max = x0 + xs.max()
-                    y_min = y0 + ys.min()
-                    y_max = y0 + ys.max()
-                    x_center = (x_min + x_max) / 2 / img.shape[1]
-                    y_center = (y_min + y_max) / 2 / img.shape[0]
-                    w = (x_max - x_min) / img.shape[1]
-                    h = (y_max - y_min) / img.shape[0]
-                    yolo_labels.append(f"{class_id} {x_center:.6f} {y_center:.6f} {w:.6f} {h:.6f}")
-
-                    if split == "train":
-                        break
-
-            # Save outputs
-            out_img_name = f"mix_{mix_idx:04d}.jpg"
-            out_mask_name = f"mix_{mix_idx:04d}.png"
-            out_label_name = f"mix_{mix_idx:04d}.txt"
-            cv2.imwrite(os.path.join(out_img_dir, out_img_name), img)
-            cv2.imwrite(os.path.join(out_mask_dir, out_mask_name), mask)
-            with open(os.path.join(out_label_dir, out_label_name), 'w') as f:
-                f.write("\n".join(yolo_labels))
+        if WRITE_MASKS and MASK_FORMAT == "png":
+            os.makedirs(out_mask_dir, exist_ok=True)
+        build_sprites(split)
+        mix_count = len(load_sprites(split))
+
+        start_idx = first_missing_mix(split, mix_count) if RESUME else 0
+        mix_indices = range(start_idx, mix_count)
+
+        if WORKERS <= 1:
+            with AsyncWriter() as writer:
+                store_masks([render_mix(split, mix_idx, writer) for mix_idx in tqdm.tqdm(mix_indices)])
+            continue
 
+        shards = [mix_indices[i:i+CHUNK_SIZE] for i in range(0, len(mix_indices), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=WORKERS, initializer=init_worker) as executor, \
+                tqdm.tqdm(total=len(mix_indices)) as progress:
+            for results in executor.map(render_shard, repeat(split), shards):
+                store_masks(results)
+                progress.update(len(results))
 
 if __name__ == '__main__':
     ensure_dirs()
-    transform_dataset()
\ No newline at end of file
+    transform_dataset()
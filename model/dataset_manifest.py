@@ -0,0 +1,180 @@
+import hashlib
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import yaml
+from PIL import Image
+
+from parse_raw_labels_into_json import RAW_LABELS_PATH, parse_raw_labels
+
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "dataset_manifest.sqlite")
+YOLO_CONFIG = os.path.join(os.path.dirname(__file__), "data.yaml")
+GLUM_DATASET_DIR = os.path.join(os.path.dirname(__file__), "glum_dataset")
+GLUM_MASKS_DIR = os.path.join(os.path.dirname(__file__), "glum_masks")
+BASIC_DATASET_DIR = os.path.join(os.path.dirname(__file__), "basic_dataset")
+SPLITS = ['train', 'val', 'test']
+WORKERS = os.cpu_count() or 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    class_id INTEGER NOT NULL,
+    split TEXT,
+    width INTEGER,
+    height INTEGER,
+    sha1 TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    mask_x0 INTEGER,
+    mask_y0 INTEGER,
+    mask_x1 INTEGER,
+    mask_y1 INTEGER,
+    mask_area INTEGER,
+    mask_mtime_ns INTEGER,
+    mask_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_split_class ON images (split, class_id);
+"""
+ADDED_COLUMNS = [('phash', 'INTEGER'), ('duplicate_of', 'TEXT')]  # added to existing manifests on connect
+IMAGE_COLUMNS = ['width', 'height', 'sha1', 'mtime_ns', 'size']
+MASK_COLUMNS = ['mask_x0', 'mask_y0', 'mask_x1', 'mask_y1', 'mask_area', 'mask_mtime_ns', 'mask_size']
+
+
+def connect(path=MANIFEST_PATH):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(images)")}
+    for column, kind in ADDED_COLUMNS:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE images ADD COLUMN {column} {kind}")
+    return conn
+
+def load_class_ids(raw_labels_path=RAW_LABELS_PATH, yolo_config=YOLO_CONFIG):
+    """Maps every labelled photo to its class id."""
+    with open(yolo_config, 'r') as f:
+        names_to_class_id = {name: class_id for class_id, name in yaml.safe_load(f)['names'].items()}
+    class_ids = {}
+    for label, files in parse_raw_labels(raw_labels_path).items():
+        if not files:
+            continue
+        if label not in names_to_class_id:
+            raise ValueError(f"{label} from {raw_labels_path} is missing in {yolo_config}")
+        for name in files:
+            class_ids[name] = names_to_class_id[label]
+    return class_ids
+
+def mask_path(name, masks_dir=GLUM_MASKS_DIR):
+    return os.path.join(masks_dir, os.path.splitext(name)[0] + ".png")
+
+def file_stat(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+def image_info(path):
+    with Image.open(path) as img:
+        w, h = img.size
+        if img.getexif().get(0x0112) in (5, 6, 7, 8):  # stored rotated by 90 degrees
+            w, h = h, w
+    with open(path, 'rb') as f:
+        sha1 = hashlib.file_digest(f, 'sha1').hexdigest()
+    return [w, h, sha1, *file_stat(path)]
+
+def mask_info(path):
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise IOError(f"Could not read {path}")
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return [None, None, None, None, 0, *file_stat(path)]
+    return [int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1,
+            int(np.count_nonzero(mask)), *file_stat(path)]
+
+def update_manifest(conn, raw_labels_path=RAW_LABELS_PATH, image_dir=GLUM_DATASET_DIR,
+                    masks_dir=GLUM_MASKS_DIR, dataset_dir=BASIC_DATASET_DIR, workers=WORKERS):
+    """Brings the manifest in line with raw_labels.txt and the dataset folders.
+
+    Photos and masks are only read again when their modification time or size
+    changed, the split of a photo is the split folder it currently lives in.
+    """
+    class_ids = load_class_ids(raw_labels_path)
+    known = {row['name']: row for row in conn.execute("SELECT * FROM images")}
+
+    splits = {}
+    for split in SPLITS:
+        split_dir = os.path.join(dataset_dir, "images", split)
+        if os.path.isdir(split_dir):
+            for name in os.listdir(split_dir):
+                splits[name] = split
+
+    present = {}
+    stale_images = []
+    stale_masks = []
+    missing_masks = []
+    for name, class_id in class_ids.items():
+        path = os.path.join(image_dir, name)
+        if not os.path.exists(path):
+            print(f"Warning: {path} does not exist!", file=sys.stderr)
+            continue
+        present[name] = (class_id, splits.get(name))
+        row = known.get(name)
+        if row is None or [row['mtime_ns'], row['size']] != file_stat(path):
+            stale_images.append(name)
+
+        if not os.path.exists(mask_path(name, masks_dir)):
+            if row is None or row['mask_size'] is not None:
+                missing_masks.append(name)
+        elif row is None or [row['mask_mtime_ns'], row['mask_size']] != file_stat(mask_path(name, masks_dir)):
+            stale_masks.append(name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        image_infos = list(executor.map(image_info, [os.path.join(image_dir, name) for name in stale_images]))
+        mask_infos = list(executor.map(mask_info, [mask_path(name, masks_dir) for name in stale_masks]))
+
+    with conn:
+        conn.executemany("DELETE FROM images WHERE name = ?", [(name,) for name in known if name not in present])
+        conn.executemany("INSERT INTO images (name, class_id, split) VALUES (?, ?, ?) "
+                         "ON CONFLICT (name) DO UPDATE SET class_id = excluded.class_id, split = excluded.split",
+                         [(name, class_id, split) for name, (class_id, split) in present.items()])
+        # the perceptual hash of dedup_dataset.py depends on the photo and its mask
+        conn.executemany(f"UPDATE images SET {', '.join(c + ' = ?' for c in IMAGE_COLUMNS)}, phash = NULL WHERE name = ?",
+                         [(*info, name) for name, info in zip(stale_images, image_infos)])
+        conn.executemany(f"UPDATE images SET {', '.join(c + ' = ?' for c in MASK_COLUMNS)}, phash = NULL WHERE name = ?",
+                         [(*info, name) for name, info in zip(stale_masks, mask_infos)] +
+                         [(*[None] * len(MASK_COLUMNS), name) for name in missing_masks])
+    return {'images': len(present), 'read_images': len(stale_images), 'read_masks': len(stale_masks)}
+
+def query_images(conn, split=None, class_id=None, with_mask=False, unique=False):
+    """Manifest rows ordered by name.
+
+    `with_mask` keeps only photos with a non-empty mask, `unique` drops the
+    near-duplicates marked by dedup_dataset.py.
+    """
+    sql = "SELECT * FROM images WHERE 1 = 1"
+    params = []
+    if split is not None:
+        sql += " AND split = ?"
+        params.append(split)
+    if class_id is not None:
+        sql += " AND class_id = ?"
+        params.append(class_id)
+    if with_mask:
+        sql += " AND mask_area > 0"
+    if unique:
+        sql += " AND duplicate_of IS NULL"
+    return conn.execute(sql + " ORDER BY name", params).fetchall()
+
+def open_manifest(path=MANIFEST_PATH):
+    conn = connect(path)
+    update_manifest(conn)
+    return conn
+
+
+if __name__ == "__main__":
+    conn = connect()
+    print(update_manifest(conn))
+    conn.close()
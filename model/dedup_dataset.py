@@ -0,0 +1,141 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import yaml
+
+from dataset_manifest import GLUM_DATASET_DIR, GLUM_MASKS_DIR, YOLO_CONFIG, open_manifest, query_images
+from mask_store import MaskStore, decode_scaled, import_png_dir
+
+HASH_SIZE = 8  # 64 bit hashes
+DCT_SIZE = 32
+MAX_DISTANCE = 6  # photos of the same class whose hashes differ in at most this many bits are duplicates
+DROP_DUPLICATES = True  # mark them in the manifest so split_dataset.py leaves them out, False only reports
+WORKERS = os.cpu_count() or 1
+
+
+def phash(gray):
+    # sign of the low DCT frequencies against their median, robust to small shifts and exposure changes
+    small = cv2.resize(gray, (DCT_SIZE, DCT_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def subject_hash(image_path, records):
+    """Perceptual hash of the masked subject, of the whole photo when there is no mask."""
+    img = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if img is None:
+        raise IOError(f"Could not read {image_path}")
+    if not records:
+        return phash(img)
+
+    mask, (x0, y0, x1, y1) = decode_scaled(max(records, key=lambda r: r['area']), img.shape)
+    return phash(img[y0:y1, x0:x1] * mask)  # the table behind the subject does not count
+
+def to_signed(value):
+    # SQLite integers are signed 64 bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def hamming(a, b):
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over hashes with the Hamming distance.
+
+    Children are keyed by their distance to the parent, so by the triangle
+    inequality a search only descends into children whose key lies within
+    `radius` of the query's distance to the parent.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, item, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, item, {})
+                return
+            node = child
+
+    def search(self, value, radius):
+        """(distance, item) of every stored hash within `radius` bits."""
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= radius:
+                matches.append((distance, item))
+            for key, child in children.items():
+                if distance - radius <= key <= distance + radius:
+                    stack.append(child)
+        return matches
+
+
+def update_hashes(conn, workers=WORKERS):
+    """Computes the missing perceptual hashes, the manifest clears them when a photo or mask changes."""
+    pending = [row['name'] for row in conn.execute("SELECT name FROM images WHERE phash IS NULL ORDER BY name")]
+    if not pending:
+        return 0
+    with MaskStore("glum") as store:
+        import_png_dir(store, GLUM_MASKS_DIR)
+        known = {entry['name'] for entry in store.entries()}
+        records = [store.records(os.path.splitext(name)[0]) if os.path.splitext(name)[0] in known else []
+                   for name in pending]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(subject_hash, [os.path.join(GLUM_DATASET_DIR, name) for name in pending],
+                                   records, chunksize=8))
+    with conn:
+        conn.executemany("UPDATE images SET phash = ? WHERE name = ?",
+                         [(to_signed(value), name) for name, value in zip(pending, hashes)])
+    return len(pending)
+
+def find_duplicates(rows, max_distance=MAX_DISTANCE):
+    """Maps every near-duplicate to the photo it repeats, the first photo of a burst is kept."""
+    duplicates = {}
+    trees = {}
+    for row in rows:
+        tree = trees.setdefault(row['class_id'], BKTree())
+        matches = tree.search(row['phash'], max_distance)
+        if matches:
+            duplicates[row['name']] = min(matches)[1]
+        else:
+            tree.add(row['phash'], row['name'])
+    return duplicates
+
+def dedup_dataset(drop=DROP_DUPLICATES, max_distance=MAX_DISTANCE, workers=WORKERS):
+    conn = open_manifest()
+    hashed = update_hashes(conn, workers)
+    # names are capture timestamps, so bursts are visited in the order they were shot
+    rows = query_images(conn)
+    duplicates = find_duplicates(rows, max_distance)
+    if drop:
+        with conn:
+            conn.execute("UPDATE images SET duplicate_of = NULL")
+            conn.executemany("UPDATE images SET duplicate_of = ? WHERE name = ?",
+                             [(original, name) for name, original in duplicates.items()])
+    conn.close()
+
+    with open(YOLO_CONFIG, 'r') as f:
+        class_names = yaml.safe_load(f)['names']
+    classes = {}
+    for row in rows:
+        counts = classes.setdefault(class_names[row['class_id']], {'images': 0, 'duplicates': 0})
+        counts['images'] += 1
+        counts['duplicates'] += row['name'] in duplicates
+    return {'hashed': hashed, 'images': len(rows), 'duplicates': len(duplicates), 'classes': classes,
+            'pairs': duplicates}
+
+
+if __name__ == "__main__":
+    print(json.dumps(dedup_dataset(), indent=2))
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import yaml
+
+from box_ops import box_iou
+from dataset_manifest import file_stat
+from tflite_detector import NUM_THREADS, Detector, latest_model_path
+
+TEST_DIR = os.path.join(os.path.dirname(__file__), "dataset", "images", "test")
+LABELS_DIR = os.path.join(os.path.dirname(__file__), "dataset", "labels", "test")
+YOLO_CONFIG = os.path.join(os.path.dirname(__file__), "data.yaml")
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), "evaluation_results.jsonl")
+WORKERS = 4
+EVAL_CONF_THRESHOLD = 0.001  # keep low confidence detections, they still count for AP
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+def load_class_names(path=YOLO_CONFIG):
+    with open(path, 'r') as f:
+        data_yaml = yaml.safe_load(f)
+    return [data_yaml['names'][i] for i in range(data_yaml['nc'])]
+
+def file_fingerprint(path):
+    return file_stat(path) if os.path.exists(path) else None
+
+def model_fingerprint(model_path, conf_threshold):
+    with open(model_path, 'rb') as f:
+        return f"{hashlib.file_digest(f, 'sha1').hexdigest()}:{conf_threshold}"
+
+def read_yolo_labels(path, img_shape):
+    """Reads box or polygon YOLO labels as (class_ids, x1 y1 x2 y2 pixel boxes)."""
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=int), np.zeros((0, 4))
+    class_ids, boxes = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            values = line.split()
+            if len(values) < 5:
+                continue
+            coords = np.array(values[1:], dtype=np.float64)
+            if len(coords) == 4:
+                xc, yc, w, h = coords
+                box = [xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2]
+            else:
+                points = coords[:len(coords) // 2 * 2].reshape(-1, 2)
+                box = [*points.min(axis=0), *points.max(axis=0)]
+            class_ids.append(int(values[0]))
+            boxes.append(box)
+    if not boxes:
+        return np.zeros(0, dtype=int), np.zeros((0, 4))
+    boxes = np.array(boxes) * (img_shape[1], img_shape[0], img_shape[1], img_shape[0])
+    return np.array(class_ids), boxes
+
+def match_predictions(pred_boxes, pred_classes, gt_boxes, gt_classes, iou_thresholds=IOU_THRESHOLDS):
+    """(n_pred, n_thresholds) true positive matrix, each ground truth is matched at most once."""
+    tp = np.zeros((len(pred_boxes), len(iou_thresholds)), dtype=bool)
+    if len(pred_boxes) == 0 or len(gt_boxes) == 0:
+        return tp
+    iou = box_iou(gt_boxes, pred_boxes)
+    iou[gt_classes[:, None] != pred_classes[None, :]] = 0
+    for t, threshold in enumerate(iou_thresholds):
+        gt_idx, pred_idx = np.nonzero(iou >= threshold)
+        if len(gt_idx) == 0:
+            continue
+        order = np.argsort(-iou[gt_idx, pred_idx], kind='stable')
+        gt_idx, pred_idx = gt_idx[order], pred_idx[order]
+        # best overlaps first, then drop reused predictions and reused ground truths
+        _, first = np.unique(pred_idx, return_index=True)
+        first = np.sort(first)
+        gt_idx, pred_idx = gt_idx[first], pred_idx[first]
+        _, first = np.unique(gt_idx, return_index=True)
+        tp[pred_idx[first], t] = True
+    return tp
+
+def compute_ap(recall, precision):
+    # COCO style 101 point interpolation of the precision envelope
+    mrec = np.concatenate(([0.0], recall, [1.0]))
+    mpre = np.concatenate(([1.0], precision, [0.0]))
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
+    x = np.linspace(0, 1, 101)
+    return np.trapezoid(np.interp(x, mrec, mpre), x)
+
+def ap_per_class(tp, conf, pred_classes, gt_classes, class_count):
+    """AP for every class and IoU threshold, NaN for classes without ground truth."""
+    order = np.argsort(-conf, kind='stable')
+    tp, pred_classes = tp[order], pred_classes[order]
+    ap = np.full((class_count, tp.shape[1]), np.nan)
+    gt_counts = np.bincount(gt_classes, minlength=class_count)
+    for class_id in range(class_count):
+        n_gt = gt_counts[class_id]
+        if n_gt == 0:
+            continue
+        class_tp = tp[pred_classes == class_id]
+        if len(class_tp) == 0:
+            ap[class_id] = 0.0
+            continue
+        tpc = class_tp.cumsum(axis=0)
+        fpc = (~class_tp).cumsum(axis=0)
+        recall = tpc / n_gt
+        precision = tpc / (tpc + fpc)
+        ap[class_id] = [compute_ap(recall[:, t], precision[:, t]) for t in range(tp.shape[1])]
+    return ap
+
+
+def evaluate(model_path, image_dir=TEST_DIR, labels_dir=LABELS_DIR, results_path=RESULTS_PATH,
+             workers=WORKERS, num_threads=NUM_THREADS, conf_threshold=EVAL_CONF_THRESHOLD):
+    """Evaluates a TFLite model on a labelled split and returns the accuracy report.
+
+    Per-image matches are stored in `results_path` and reused as long as the
+    model, the image and its label file are unchanged.
+    """
+    class_names = load_class_names()
+    model_key = model_fingerprint(model_path, conf_threshold)
+
+    cached = {}
+    if results_path and os.path.exists(results_path):
+        with open(results_path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                cached[record['image']] = record
+
+    names = sorted(os.listdir(image_dir))
+    keys = {}
+    pending = []
+    for name in names:
+        label_path = os.path.join(labels_dir, os.path.splitext(name)[0] + ".txt")
+        keys[name] = [model_key, file_fingerprint(os.path.join(image_dir, name)), file_fingerprint(label_path)]
+        if cached.get(name, {}).get('key') != keys[name]:
+            pending.append(name)
+
+    local = threading.local()
+
+    def process(name):
+        if not hasattr(local, 'detector'):
+            local.detector = Detector(model_path, num_threads=num_threads, conf_threshold=conf_threshold)
+        img = cv2.imread(os.path.join(image_dir, name))
+        if img is None:
+            print(f"Warning: could not read {name}, skipping it")
+            return {'image': name, 'key': keys[name], 'error': "could not read image"}
+        gt_classes, gt_boxes = read_yolo_labels(os.path.join(labels_dir, os.path.splitext(name)[0] + ".txt"), img.shape[:2])
+        boxes, scores, pred_classes = local.detector.detect(img)
+        tp = match_predictions(boxes, pred_classes, gt_boxes, gt_classes)
+        return {'image': name, 'key': keys[name], 'tp': np.packbits(tp, axis=1).tolist(),
+                'conf': scores.tolist(), 'pred_cls': pred_classes.tolist(), 'target_cls': gt_classes.tolist()}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record in executor.map(process, pending):
+            cached[record['image']] = record
+    elapsed = time.perf_counter() - start
+
+    records = [cached[name] for name in names]
+    if results_path:
+        with open(results_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    errors = [record['image'] for record in records if 'error' in record]
+    records = [record for record in records if 'error' not in record]
+
+    n_thresholds = len(IOU_THRESHOLDS)
+    tp = np.concatenate([np.unpackbits(np.array(r['tp'], dtype=np.uint8).reshape(-1, (n_thresholds + 7) // 8),
+                                       axis=1, count=n_thresholds).astype(bool) for r in records]) \
+        if records else np.zeros((0, n_thresholds), dtype=bool)
+    conf = np.array([c for r in records for c in r['conf']])
+    pred_classes = np.array([c for r in records for c in r['pred_cls']], dtype=int)
+    gt_classes = np.array([c for r in records for c in r['target_cls']], dtype=int)
+
+    ap = ap_per_class(tp, conf, pred_classes, gt_classes, len(class_names))
+    present = ~np.isnan(ap[:, 0])
+    return {
+        "images": len(records),
+        "errors": errors,
+        "evaluated": len(pending),
+        "images_per_sec": round(len(pending) / elapsed, 2) if pending and elapsed > 0 else None,
+        "mAP50": float(ap[present, 0].mean()) if present.any() else 0.0,
+        "mAP50-95": float(ap[present].mean()) if present.any() else 0.0,
+        "per_class_AP50-95": {name: (None if np.isnan(ap[i, 0]) else round(float(ap[i].mean()), 4))
+                              for i, name in enumerate(class_names)},
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(evaluate(latest_model_path()), indent=2))
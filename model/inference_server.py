@@ -0,0 +1,161 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+
+from tflite_detector import NUM_THREADS, Detector, detections_to_records, latest_model_path, load_label_names
+
+HOST = "127.0.0.1"
+PORT = 8000
+WORKERS = 2  # interpreter instances
+MAX_QUEUE = 256
+REQUEST_TIMEOUT = 30.0
+
+
+class InterpreterPool:
+    """Runs queued requests on a pool of interpreters, one thread per interpreter.
+
+    The exported model has a fixed batch size of 1, so grouping requests would
+    only add waiting time. An idle interpreter takes the oldest request right
+    away, and requests whose caller gave up are dropped instead of being run.
+    """
+
+    def __init__(self, model_path, workers=WORKERS, num_threads=NUM_THREADS, max_queue=MAX_QUEUE):
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.workers = workers
+
+        self.lock = threading.Lock()
+        self.served = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.latencies = deque(maxlen=1000)
+
+        self.threads = [threading.Thread(target=self.run, args=(Detector(model_path, num_threads=num_threads),), daemon=True)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, img):
+        """Queues an image, raises queue.Full when the server is saturated."""
+        future = Future()
+        self.requests.put_nowait((img, future, time.perf_counter()))
+        return future
+
+    def run(self, detector):
+        while True:
+            img, future, enqueued = self.requests.get()
+            if not future.set_running_or_notify_cancel():
+                with self.lock:
+                    self.cancelled += 1
+                continue
+            try:
+                future.set_result(detector.detect(img))
+                latency = time.perf_counter() - enqueued
+                with self.lock:
+                    self.served += 1
+                    self.latencies.append(latency)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                future.set_exception(e)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            metrics = {
+                "queue_depth": self.requests.qsize(),
+                "served": self.served,
+                "errors": self.errors,
+                "cancelled": self.cancelled,
+            }
+        if len(latencies):
+            metrics["latency_ms"] = {"p50": round(float(np.percentile(latencies, 50)), 3),
+                                     "p99": round(float(np.percentile(latencies, 99)), 3)}
+        return metrics
+
+
+def extract_upload(content_type, body):
+    # accepts raw image bytes as well as a multipart form with a single file field
+    if not content_type.startswith("multipart/form-data"):
+        return body
+    message = BytesParser(policy=default_policy).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    for part in message.iter_parts():
+        if part.get_filename() or part.get_content_maintype() == "image":
+            return part.get_payload(decode=True)
+    return None
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    pool = None
+    label_names = None
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "workers": self.pool.workers})
+        elif self.path == "/metrics":
+            self.send_json(200, self.pool.metrics())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/detect":
+            self.send_json(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        data = extract_upload(self.headers.get("Content-Type", ""), body)
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR) if data else None
+        if img is None:
+            self.send_json(400, {"error": "could not decode image"})
+            return
+
+        try:
+            future = self.pool.submit(img)
+        except queue.Full:
+            self.send_json(503, {"error": "server busy"})
+            return
+        try:
+            boxes, scores, class_ids = future.result(timeout=REQUEST_TIMEOUT)
+        except TimeoutError:
+            future.cancel()  # still queued, the pool skips it
+            self.send_json(504, {"error": "timed out"})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"detections": detections_to_records(boxes, scores, class_ids, self.label_names)})
+
+    def log_message(self, format, *args):
+        pass  # keep the hot path quiet, /metrics has the numbers
+
+
+def serve(model_path, host=HOST, port=PORT):
+    InferenceHandler.pool = InterpreterPool(model_path)
+    InferenceHandler.label_names = load_label_names()
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    print(f"Serving {model_path} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve(latest_model_path())
@@ -0,0 +1,52 @@
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from inference_server import HOST, PORT
+
+URL = f"http://{HOST}:{PORT}"
+IMAGE_PATH = "testimg.jpg"
+CONCURRENCY = 8
+REQUESTS = 200
+
+
+def post_image(url, data):
+    request = urllib.request.Request(url + "/detect", data=data, headers={"Content-Type": "image/jpeg"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            ok = response.status == 200
+    except urllib.error.URLError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+def run_load(url=URL, image_path=IMAGE_PATH, concurrency=CONCURRENCY, requests=REQUESTS):
+    with open(image_path, 'rb') as f:
+        data = f.read()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: post_image(url, data), range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, ok in results if ok]) * 1000
+    report = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(not ok for _, ok in results),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+    }
+    if len(latencies):
+        report["latency_ms"] = {"p50": round(float(np.percentile(latencies, 50)), 3),
+                                "p99": round(float(np.percentile(latencies, 99)), 3)}
+    with urllib.request.urlopen(url + "/metrics") as response:
+        report["server"] = json.load(response)
+    return report
+
+
+if __name__ == "__main__":
+    print(json.dumps(run_load(), indent=2))
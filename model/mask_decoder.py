@@ -0,0 +1,51 @@
+import numpy as np
+import cv2
+
+from polygons import mask_to_polygons
+from rle import rle_encode
+
+MASK_THRESHOLD = 0.5
+MASK_FORMATS = ("bitmap", "rle", "polygon")
+
+
+def decode_masks(coeffs, protos, boxes, r, dw, dh, input_shape, threshold=MASK_THRESHOLD):
+    """Builds the instance mask of every detection, cropped to its box.
+
+    `coeffs` are the mask coefficients of the surviving detections, `protos` the
+    (h, w, n) prototype tensor and `boxes` the integer x1, y1, x2, y2 boxes in
+    original image pixels. Prototypes are only combined inside each box and the
+    result is upsampled straight to the box size.
+    """
+    proto_h, proto_w, _ = protos.shape
+    sx = proto_w / input_shape[1]
+    sy = proto_h / input_shape[0]
+    # sigmoid(logit) > threshold without evaluating the sigmoid
+    logit_threshold = np.log(threshold / (1 - threshold))
+
+    masks = []
+    for coeff, (x1, y1, x2, y2) in zip(coeffs, boxes):
+        box_w, box_h = max(x2 - x1, 1), max(y2 - y1, 1)
+        # the box in prototype pixels, through the letterbox
+        cx0 = min(max(int(np.floor((x1 * r + dw) * sx)), 0), proto_w - 1)
+        cy0 = min(max(int(np.floor((y1 * r + dh) * sy)), 0), proto_h - 1)
+        cx1 = max(min(int(np.ceil((x2 * r + dw) * sx)), proto_w), cx0 + 1)
+        cy1 = max(min(int(np.ceil((y2 * r + dh) * sy)), proto_h), cy0 + 1)
+        logits = protos[cy0:cy1, cx0:cx1] @ coeff
+
+        # map every box pixel center back into the prototype crop
+        warp = np.array([[r * sx, 0, ((x1 + 0.5) * r + dw) * sx - 0.5 - cx0],
+                         [0, r * sy, ((y1 + 0.5) * r + dh) * sy - 0.5 - cy0]], dtype=np.float32)
+        logits = cv2.warpAffine(logits.astype(np.float32), warp, (box_w, box_h),
+                                flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        masks.append(logits > logit_threshold)
+    return masks
+
+def format_masks(masks, boxes, img_shape, mask_format="bitmap"):
+    """Returns box crops as they are, COCO RLE of the full image or normalized polygons."""
+    if mask_format == "bitmap":
+        return masks
+    if mask_format == "rle":
+        return [rle_encode(mask, (x1, y1), img_shape) for mask, (x1, y1, _, _) in zip(masks, boxes)]
+    if mask_format == "polygon":
+        return [mask_to_polygons(mask, (x1, y1), img_shape) for mask, (x1, y1, _, _) in zip(masks, boxes)]
+    raise ValueError(f"Unknown mask format {mask_format}, expected one of {MASK_FORMATS}")
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import tqdm
+
+from rle import rle_decode_crop, rle_encode
+
+MASK_STORE_DIR = os.path.join(os.path.dirname(__file__), "mask_store")
+WORKERS = os.cpu_count() or 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT PRIMARY KEY,
+    height INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    source_mtime_ns INTEGER,
+    source_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS masks (
+    name TEXT NOT NULL,
+    class_id INTEGER NOT NULL,
+    x0 INTEGER NOT NULL,
+    y0 INTEGER NOT NULL,
+    x1 INTEGER NOT NULL,
+    y1 INTEGER NOT NULL,
+    area INTEGER NOT NULL,
+    counts BLOB NOT NULL,
+    PRIMARY KEY (name, class_id)
+);
+"""
+
+
+def encode_label_mask(mask):
+    """RLE records of a mask holding class_id + 1 per pixel, one per class present."""
+    records = []
+    for value in np.unique(mask):
+        if value == 0:
+            continue
+        binary = mask == value
+        rows = np.flatnonzero(binary.any(axis=1))
+        cols = np.flatnonzero(binary.any(axis=0))
+        x0, y0, x1, y1 = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+        # encode the crop only, the offset places it on the full mask
+        rle = rle_encode(binary[y0:y1, x0:x1], (x0, y0), mask.shape)
+        records.append({'class_id': int(value) - 1, 'size': list(mask.shape), 'bbox': (x0, y0, x1, y1),
+                        'area': int(np.count_nonzero(binary[y0:y1, x0:x1])),
+                        'counts': np.asarray(rle['counts'], dtype=np.uint32)})
+    return records
+
+def load_png_records(path):
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise IOError(f"Could not read {path}")
+    return mask.shape, encode_label_mask(mask)
+
+def decode_scaled(record, shape):
+    """The binary mask inside the bbox of a record, resized for the source image scaled to `shape`.
+
+    Returns the mask and its scaled bbox, only the bbox is decoded.
+    """
+    src_h, src_w = record['size']
+    target_h, target_w = shape
+    x0, y0, x1, y1 = record['bbox']
+    sx0, sy0 = x0 * target_w // src_w, y0 * target_h // src_h
+    sx1, sy1 = -(-x1 * target_w // src_w), -(-y1 * target_h // src_h)
+    mask = cv2.resize(rle_decode_crop(record, record['bbox']).astype(np.uint8), (sx1 - sx0, sy1 - sy0),
+                      interpolation=cv2.INTER_NEAREST)
+    return mask, (sx0, sy0, sx1, sy1)
+
+def records_digest(records):
+    digest = hashlib.sha1()
+    for record in records:
+        digest.update(np.int64(record['class_id']).tobytes())
+        digest.update(record['counts'].tobytes())
+    return digest.hexdigest()
+
+
+class MaskStore:
+    """Run-length encoded masks with their class, bbox and area, in a single SQLite file.
+
+    Every entry is one mask image, stored as one COCO-style RLE per class it
+    contains. Metadata queries never touch the runs, and `decode_crop` only
+    expands the pixels inside the bbox of a class.
+    """
+
+    def __init__(self, name, store_dir=MASK_STORE_DIR):
+        os.makedirs(store_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(store_dir, name + ".sqlite"))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def put(self, name, shape, records, source_stat=None):
+        source_stat = source_stat or [None, None]
+        with self.conn:
+            self.conn.execute("DELETE FROM masks WHERE name = ?", (name,))
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                              (name, shape[0], shape[1], records_digest(records), *source_stat))
+            self.conn.executemany("INSERT INTO masks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  [(name, r['class_id'], *r['bbox'], r['area'], r['counts'].tobytes()) for r in records])
+
+    def put_mask(self, name, mask, source_stat=None):
+        self.put(name, mask.shape, encode_label_mask(mask), source_stat)
+
+    def remove(self, name):
+        with self.conn:
+            self.conn.execute("DELETE FROM masks WHERE name = ?", (name,))
+            self.conn.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+    def entries(self, prefix=""):
+        """Entry rows ordered by name: name, height, width, digest and the stat of an imported source."""
+        return self.conn.execute("SELECT * FROM entries WHERE substr(name, 1, ?) = ? ORDER BY name",
+                                 (len(prefix), prefix)).fetchall()
+
+    def records(self, name):
+        entry = self.conn.execute("SELECT height, width FROM entries WHERE name = ?", (name,)).fetchone()
+        if entry is None:
+            raise KeyError(name)
+        rows = self.conn.execute("SELECT * FROM masks WHERE name = ? ORDER BY class_id", (name,)).fetchall()
+        return [{'class_id': row['class_id'], 'size': [entry['height'], entry['width']],
+                 'bbox': (row['x0'], row['y0'], row['x1'], row['y1']), 'area': row['area'],
+                 'counts': np.frombuffer(row['counts'], dtype=np.uint32)} for row in rows]
+
+    def decode(self, name):
+        """The full mask with class_id + 1 per pixel."""
+        entry = self.conn.execute("SELECT height, width FROM entries WHERE name = ?", (name,)).fetchone()
+        if entry is None:
+            raise KeyError(name)
+        mask = np.zeros((entry['height'], entry['width']), dtype=np.uint8)
+        for record in self.records(name):
+            x0, y0, x1, y1 = record['bbox']
+            mask[y0:y1, x0:x1][rle_decode_crop(record, record['bbox'])] = record['class_id'] + 1
+        return mask
+
+    def decode_crop(self, record):
+        """The binary mask inside the bbox of a record and its (x, y) offset."""
+        return rle_decode_crop(record, record['bbox']), record['bbox'][:2]
+
+
+def import_png_dir(store, mask_dir, prefix="", workers=WORKERS):
+    """Mirrors the PNG masks of `mask_dir` into the store as `prefix` + file stem.
+
+    Only masks whose mtime or size changed are decoded, entries of deleted
+    PNGs are dropped. Entries that were not imported from PNGs are left alone.
+    """
+    known = {row['name']: [row['source_mtime_ns'], row['source_size']] for row in store.entries(prefix)}
+    names = {}
+    for file_name in sorted(os.listdir(mask_dir)):
+        if file_name.endswith('.png'):
+            st = os.stat(os.path.join(mask_dir, file_name))
+            names[prefix + file_name[:-4]] = (file_name, [st.st_mtime_ns, st.st_size])
+
+    stale = [name for name, (_, stat) in names.items() if known.get(name) != stat]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = executor.map(load_png_records, [os.path.join(mask_dir, names[name][0]) for name in stale], chunksize=8)
+        for name, (shape, records) in tqdm.tqdm(zip(stale, jobs), total=len(stale), desc=os.path.basename(mask_dir)):
+            store.put(name, shape, records, names[name][1])
+
+    for name, stat in known.items():
+        if stat[0] is not None and name not in names:
+            store.remove(name)
+    return len(stale)
+
+def export_png_dir(store, out_dir, prefix=""):
+    # full-size PNGs again, e.g. for inspection
+    os.makedirs(out_dir, exist_ok=True)
+    for entry in store.entries(prefix):
+        cv2.imwrite(os.path.join(out_dir, entry['name'][len(prefix):] + ".png"), store.decode(entry['name']))
@@ -1,13 +1,15 @@
 import os
 from ultralytics import YOLO
 
-from ultralytics.data.converter import convert_segment_masks_to_yolo_seg
+from streaming_dataset import StreamingMixTrainer
 
 MODELS_DIR = "yolo_models"
+STREAM_MIXES = True  # compose fresh training mixes every epoch instead of reading dataset/images/train
 
-model = YOLO(os.path.join(MODELS_DIR, "yolo11n.pt"))
+model = YOLO(os.path.join(MODELS_DIR, "yolo11n-seg.pt"))
 
 results = model.train(
+    trainer=StreamingMixTrainer if STREAM_MIXES else None,
     data="data.yaml",
     project="gloomhaven-monster-recognizer",
     epochs=200,
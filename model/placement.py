@@ -0,0 +1,70 @@
+import numpy as np
+import cv2
+
+MIN_CLEAR_FRACTION = 0.5
+RANDOM_CANDIDATES = 256
+
+
+class PlacementEngine:
+    """Finds spots on a canvas where a sprite covers enough free background.
+
+    Occupied pixels are tracked in a summed-area table, rebuilt by cv2.integral
+    before the first search after a paste, so the occupancy of any sprite-sized
+    box is four lookups.
+    """
+
+    def __init__(self, height, width, min_clear=MIN_CLEAR_FRACTION, candidates=RANDOM_CANDIDATES):
+        self.height = height
+        self.width = width
+        self.min_clear = min_clear
+        self.candidates = candidates
+        self.occupancy = np.zeros((height, width), dtype=np.uint8)
+        self.sat = np.zeros((height + 1, width + 1), dtype=np.int32)
+        self.dirty = False
+
+    def box_sums(self, ys, xs, h, w):
+        sat = self.sat
+        return sat[ys + h, xs + w] - sat[ys, xs + w] - sat[ys + h, xs] + sat[ys, xs]
+
+    def find(self, region, rng):
+        """Returns (y0, x0) for the boolean sprite `region` or None if no spot exists."""
+        h, w = region.shape
+        max_x = self.width - w
+        max_y = self.height - h
+        if max_x <= 0 or max_y <= 0:
+            return None
+
+        area = int(np.count_nonzero(region))
+        if area == 0:
+            return None
+        allowed_overlap = area * (1.0 - self.min_clear)
+        if self.dirty:
+            cv2.integral(self.occupancy, self.sat, sdepth=cv2.CV_32S)
+            self.dirty = False
+
+        # The occupancy of the whole box bounds the overlap with the sprite from above,
+        # so a box under the budget is always a valid spot. Try random ones first.
+        ys = rng.integers(0, max_y, self.candidates)
+        xs = rng.integers(0, max_x, self.candidates)
+        sure = np.flatnonzero(self.box_sums(ys, xs, h, w) <= allowed_overlap)
+        if len(sure):
+            return int(ys[sure[0]]), int(xs[sure[0]])
+
+        # Score every position at once
+        box = self.box_sums(np.arange(max_y)[:, None], np.arange(max_x)[None, :], h, w)
+        sure = np.flatnonzero(box <= allowed_overlap)
+        if len(sure):
+            return divmod(int(rng.choice(sure)), max_x)
+
+        # Boxes are too crowded, count the exact overlap with the sprite shape
+        overlap = cv2.matchTemplate(self.occupancy.astype(np.float32), region.astype(np.float32), cv2.TM_CCORR)
+        # float32 correlation is off by rounding, the overlap itself is a whole pixel count
+        valid = np.flatnonzero(overlap[:max_y, :max_x] <= np.floor(allowed_overlap) + 0.5)
+        if len(valid):
+            return divmod(int(rng.choice(valid)), max_x)
+        return None
+
+    def place(self, y0, x0, region):
+        h, w = region.shape
+        self.occupancy[y0:y0+h, x0:x0+w][region] = 1
+        self.dirty = True
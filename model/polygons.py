@@ -0,0 +1,27 @@
+import numpy as np
+import cv2
+
+
+def mask_to_polygons(mask, offset=(0, 0), canvas_shape=None, tolerance=0.0):
+    """Traces the outer contours of a binary mask as normalized YOLO polygons.
+
+    `offset` is the (x, y) position of the mask on a canvas of `canvas_shape`
+    (height, width), which defaults to the mask itself.
+    """
+    if canvas_shape is None:
+        canvas_shape = mask.shape[:2]
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    polygons = []
+    for contour in contours:
+        if tolerance > 0:
+            contour = cv2.approxPolyDP(contour, tolerance, True)
+        if len(contour) < 3:
+            continue
+        polygon = contour.reshape(-1, 2).astype(np.float64) + offset
+        polygon /= (canvas_shape[1], canvas_shape[0])
+        polygons.append(polygon)
+    return polygons
+
+def format_polygon_label(class_id, polygon):
+    return f"{class_id} " + " ".join(f"{x:.6f} {y:.6f}" for x, y in polygon)
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def rle_encode(mask, offset=(0, 0), shape=None):
+    """COCO-style RLE of a binary mask placed at `offset` (x, y) on an image of `shape`.
+
+    Runs are counted in column-major order starting with background, so a mask
+    crop can be encoded for the full image without materializing it.
+    """
+    h, w = mask.shape
+    img_h, img_w = shape if shape is not None else (h, w)
+    x0, y0 = offset
+
+    # pad every column with background so each run starts and ends inside it
+    cols = np.zeros((w, h + 2), dtype=np.int8)
+    cols[:, 1:-1] = mask.T
+    edges = np.diff(cols, axis=1)
+    start_x, start_y = np.nonzero(edges == 1)
+    end_x, end_y = np.nonzero(edges == -1)
+    starts = (x0 + start_x) * img_h + y0 + start_y
+    ends = (x0 + end_x) * img_h + y0 + end_y
+
+    # a run ending at the bottom of one column may continue at the top of the next
+    joined = starts[1:] == ends[:-1]
+    starts = np.concatenate((starts[:1], starts[1:][~joined]))
+    ends = np.concatenate((ends[:-1][~joined], ends[-1:]))
+
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = img_h * img_w
+    counts = np.diff(bounds)
+    if len(counts) > 1 and counts[-1] == 0:
+        counts = counts[:-1]
+    return {"size": [img_h, img_w], "counts": counts.tolist()}
+
+def rle_decode(rle):
+    img_h, img_w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    flat = np.zeros(img_h * img_w, dtype=bool)
+    runs = np.repeat(values, counts)
+    flat[:len(runs)] = runs
+    return flat.reshape(img_w, img_h).T
+
+def rle_runs(rle):
+    # [start, end) of every foreground run in column-major pixel order
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    n = len(counts) // 2
+    return bounds[1:2*n+1:2], bounds[2:2*n+2:2]
+
+def rle_area(rle):
+    return int(np.asarray(rle["counts"], dtype=np.int64)[1::2].sum())
+
+def rle_bbox(rle):
+    """Pixel bbox (x0, y0, x1, y1) of the foreground, None for an empty mask."""
+    img_h = rle["size"][0]
+    starts, ends = rle_runs(rle)
+    keep = ends > starts
+    starts, last = starts[keep], ends[keep] - 1
+    if len(starts) == 0:
+        return None
+    # a run covering several columns touches the top and the bottom of the image
+    wraps = last // img_h > starts // img_h
+    y0 = np.where(wraps, 0, starts % img_h).min()
+    y1 = np.where(wraps, img_h - 1, last % img_h).max() + 1
+    return int(starts[0] // img_h), int(y0), int(last[-1] // img_h + 1), int(y1)
+
+def rle_decode_crop(rle, bbox):
+    """Decodes only the pixels inside `bbox` (x0, y0, x1, y1)."""
+    img_h = rle["size"][0]
+    x0, y0, x1, y1 = bbox
+    lo, hi = x0 * img_h, x1 * img_h
+    starts, ends = rle_runs(rle)
+    starts = np.clip(starts, lo, hi) - lo
+    ends = np.clip(ends, lo, hi) - lo
+    keep = ends > starts
+    # runs never touch each other, so every edge index is unique
+    edges = np.zeros(hi - lo + 1, dtype=np.int8)
+    edges[starts[keep]] = 1
+    edges[ends[keep]] = -1
+    cols = np.cumsum(edges[:-1], dtype=np.int8).astype(bool).reshape(x1 - x0, img_h)
+    return cols[:, y0:y1].T
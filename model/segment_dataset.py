@@ -1,115 +1,179 @@
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 import tqdm
 from PIL import Image, ImageOps
 import numpy as np
 import yaml
-import json
+import torch
 
 import matplotlib.pyplot as plt
 from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 
+from dataset_manifest import GLUM_DATASET_DIR, mask_path, open_manifest, query_images
 
-LABELS_PATH = os.path.join(os.path.dirname(__file__), 'labels.json')
 YOLO_CONFIG = os.path.join(os.path.dirname(__file__), 'data.yaml')
-DATASET_IMAGES_DIR = os.path.join(os.path.dirname(__file__), 'dataset/images')
-DATASET_MASKS_DIR = os.path.join(os.path.dirname(__file__), 'dataset/masks')
 
 SAM2_CHECKPOINT = os.path.join(os.path.dirname(__file__),"sam2-repo/checkpoints/sam2.1_hiera_large.pt")
 MODEL_CFG = "configs/sam2.1/sam2.1_hiera_l.yaml"
-
-names_to_class_id = {}
-images_to_class_id = {}
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+EMBEDDING_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'sam2_embeddings')
+PREFETCH_DEPTH = 2  # images encoded ahead of the one being annotated
+DISPLAY_MAX_SIZE = 1600  # longest side of the image shown while annotating
 
 with open(YOLO_CONFIG, 'r') as f:
     data_yaml = yaml.safe_load(f)
     class_names = data_yaml['names']
 
-    for class_id, class_name in class_names.items():
-        names_to_class_id[class_name] = class_id
 
-with open(LABELS_PATH, 'r') as f:
-    labels = json.load(f)
-    for label in labels:
-        for image in label['files']:
-            images_to_class_id[os.path.basename(image)] = names_to_class_id[label['name']]
+sam2_model = build_sam2(MODEL_CFG, SAM2_CHECKPOINT, device=DEVICE)
+predictor = SAM2ImagePredictor(sam2_model)
+
 
+def load_image(image_path):
+    return ImageOps.exif_transpose(Image.open(image_path)).convert("RGB")
 
-sam2_model = build_sam2(MODEL_CFG, SAM2_CHECKPOINT, device="cuda")
-predictor = SAM2ImagePredictor(sam2_model)
+def embedding_cache_path(image_path):
+    # the embedding depends on the pixels and the encoder weights, not on the file name
+    digest = hashlib.sha1()
+    with open(image_path, 'rb') as f:
+        digest.update(hashlib.file_digest(f, 'sha1').digest())
+    digest.update(f"{MODEL_CFG}:{os.path.getsize(SAM2_CHECKPOINT)}".encode())
+    return os.path.join(EMBEDDING_CACHE_DIR, digest.hexdigest() + '.pt')
+
+def encode_image(encoder, image_path, image):
+    """Returns the SAM2 image features and original size, from the disk cache when possible."""
+    cache_path = embedding_cache_path(image_path)
+    if os.path.exists(cache_path):
+        cached = torch.load(cache_path, map_location=DEVICE)
+        return cached['features'], tuple(cached['orig_hw'])
+
+    encoder.set_image(image)
+    features, orig_hw = encoder._features, encoder._orig_hw[0]
+
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    torch.save({'features': {'image_embed': features['image_embed'].cpu(),
+                             'high_res_feats': [feat.cpu() for feat in features['high_res_feats']]},
+                'orig_hw': list(orig_hw)}, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return features, orig_hw
+
+def set_features(features, orig_hw):
+    # skips the encoder, the prompt decoder only needs these
+    predictor.reset_predictor()
+    predictor._features = features
+    predictor._orig_hw = [orig_hw]
+    predictor._is_batch = False
+    predictor._is_image_set = True
+
+
+class EmbeddingPrefetcher:
+    """Loads and encodes upcoming images on a background thread.
+
+    The encoder is a second predictor sharing the model weights, so the main
+    predictor stays free for prompts while the next images are encoded.
+    """
+
+    def __init__(self, model, depth=PREFETCH_DEPTH):
+        self.encoder = SAM2ImagePredictor(model)
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = {}
+
+    def schedule(self, image_paths):
+        for image_path in image_paths[:self.depth + 1]:
+            if image_path not in self.futures:
+                self.futures[image_path] = self.executor.submit(self.load, image_path)
+
+    def load(self, image_path):
+        image = load_image(image_path)
+        features, orig_hw = encode_image(self.encoder, image_path, image)
+        return image, features, orig_hw
 
+    def get(self, image_path):
+        future = self.futures.pop(image_path, None) or self.executor.submit(self.load, image_path)
+        return future.result()
 
-def show_points(coords, labels, ax, marker_size=375):
-    pos_points = coords[labels==1]
-    neg_points = coords[labels==0]
-    ax.scatter(pos_points[:, 0], pos_points[:, 1], color='green', marker='*', s=marker_size, edgecolor='white', linewidth=1.25)
-    ax.scatter(neg_points[:, 0], neg_points[:, 1], color='red', marker='*', s=marker_size, edgecolor='white', linewidth=1.25)
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
 
-def run_segmentation_tool(image_path, mask_path, class_id):
+
+def precompute_embeddings(image_paths):
+    for image_path in tqdm.tqdm(image_paths, desc="Encoding images"):
+        encode_image(predictor, image_path, load_image(image_path))
+
+
+def show_points(coords, labels, pos_scatter, neg_scatter):
+    pos_scatter.set_offsets(coords[labels==1].reshape(-1, 2))
+    neg_scatter.set_offsets(coords[labels==0].reshape(-1, 2))
+
+def run_segmentation_tool(image_path, mask_path, class_id, prefetcher):
 
     exit_flag = False
 
-    image = Image.open(image_path)
-    image = ImageOps.exif_transpose(image)
+    image, features, orig_hw = prefetcher.get(image_path)
 
     w, h = image.size
 
-    predictor.set_image(image)
+    set_features(features, orig_hw)
 
     input_points = []
     input_labels = []
     mask = None
+    mask_logits = None
+
+    # draw a downsampled copy, the extent keeps click coordinates in full resolution pixels
+    step = max(1, -(-max(w, h) // DISPLAY_MAX_SIZE))
+    display_image = image.reduce(step)
+    overlay = np.zeros((display_image.height, display_image.width, 4), dtype=np.uint8)
 
     fig, ax = plt.subplots(figsize=(12, 12))
 
     plt.axis('off')
-    ax.imshow(image)
+    ax.imshow(display_image, extent=(0, w, h, 0))
+    overlay_artist = ax.imshow(overlay, extent=(0, w, h, 0))
+    pos_scatter = ax.scatter([], [], color='green', marker='*', s=375, edgecolor='white', linewidth=1.25)
+    neg_scatter = ax.scatter([], [], color='red', marker='*', s=375, edgecolor='white', linewidth=1.25)
+    ax.set_xlim(0, w)
+    ax.set_ylim(h, 0)
 
     ax.text(0.02, -0.01, f"Segmenting {class_names[class_id]} with id {class_id}", transform=ax.transAxes, fontsize=16, color='white',
                     verticalalignment='top', bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.3'))
+    score_artist = ax.text(0.02, 1.033, "", transform=ax.transAxes, fontsize=16, color='white', visible=False,
+                    verticalalignment='top', bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.3'))
 
-    color = np.array([30/255, 144/255, 255/255, 0.6])
+    color = np.array([30, 144, 255, 153], dtype=np.uint8)
 
     def update_mask_and_display():
-        nonlocal mask, ax
-        ax.clear()
+        nonlocal mask, mask_logits
 
-        plt.axis('off')
-        ax.imshow(image)
+        points_np = np.array(input_points).reshape(-1, 2)
+        labels_np = np.array(input_labels)
+        show_points(points_np, labels_np, pos_scatter, neg_scatter)
 
-        score_text = None
         if input_points:
-            points_np = np.array(input_points)
-            labels_np = np.array(input_labels)
-
-            show_points(points_np, labels_np, ax)
-
+            # one point is ambiguous, later points refine the previous best mask
             masks, scores, logits = predictor.predict(
                 point_coords=points_np,
                 point_labels=labels_np,
-                multimask_output=True
+                mask_input=mask_logits,
+                multimask_output=len(input_points) == 1
             )
 
-            sorted_ind = np.argsort(scores)[::-1]
-            masks = masks[sorted_ind]
-            scores = scores[sorted_ind]
-            mask = masks[0]
-            score = scores[0]
-            score_text = f"Mask score: {score:.4f}"
-
-            h_mask, w_mask = mask.shape[-2:]
-            mask_uint8 = mask.astype(np.uint8)
-            mask_image = mask_uint8.reshape(h_mask, w_mask, 1) * color.reshape(1, 1, -1)
-            
-            ax.imshow(mask_image)
-
-        if score_text:
-            ax.text(0.02, 1.033, score_text, transform=ax.transAxes, fontsize=16, color='white',
-                    verticalalignment='top', bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.3'))
+            best = np.argmax(scores)
+            mask = masks[best]
+            mask_logits = logits[best][None]
 
-        ax.text(0.02, -0.01, f"Segmenting {class_names[class_id]} with id {class_id}", transform=ax.transAxes, fontsize=16, color='white',
-                    verticalalignment='top', bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.3'))
+            np.multiply(mask[::step, ::step, None].astype(np.uint8), color, out=overlay)
+            score_artist.set_text(f"Mask score: {scores[best]:.4f}")
+            score_artist.set_visible(True)
+        else:
+            overlay[:] = 0
+            score_artist.set_visible(False)
 
+        overlay_artist.set_data(overlay)
         fig.canvas.draw_idle()
 
     def on_click(event):
@@ -125,11 +189,12 @@ def run_segmentation_tool(image_path, mask_path, class_id):
             update_mask_and_display()
 
     def on_key(event):
-        nonlocal exit_flag
+        nonlocal exit_flag, mask_logits
         if event.key == 'ctrl+z' or event.key == 'control+z':
             if input_points:
                 input_points.pop()
                 input_labels.pop()
+                mask_logits = None  # the refined mask belonged to the removed point
                 update_mask_and_display()
         elif event.key == 'n':
             plt.close(fig)
@@ -150,6 +215,7 @@ def run_segmentation_tool(image_path, mask_path, class_id):
     mask_uint8 = mask.astype(np.uint8)
     mask_image = mask_uint8 * (class_id + 1)
     mask_image = Image.fromarray(mask_image)
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
     mask_image.save(mask_path)
 
     return exit_flag
@@ -157,21 +223,26 @@ def run_segmentation_tool(image_path, mask_path, class_id):
 if __name__ == "__main__":
 
     SKIP_ALREADY_SEGMENTED = True
-
-    # start the segmentation process
-    for dir_name in os.listdir(DATASET_IMAGES_DIR):
-        exit_flag = False
-        for image_path in os.listdir(os.path.join(DATASET_IMAGES_DIR, dir_name)):
-            class_id = images_to_class_id[image_path]
-            mask_path = os.path.join(DATASET_MASKS_DIR, dir_name, os.path.basename(image_path))[:-4] + '.png'
-            original_image_path = os.path.join(DATASET_IMAGES_DIR, dir_name, image_path)
-
-            if SKIP_ALREADY_SEGMENTED and os.path.exists(mask_path):
-                continue
-
-            exit_flag = run_segmentation_tool(original_image_path, mask_path, class_id)
-
-            if exit_flag:
-                break
-        if exit_flag:
-            break
\ No newline at end of file
+    PRECOMPUTE_ONLY = False  # only fill the embedding cache, e.g. overnight on a GPU machine
+
+    conn = open_manifest()
+    jobs = []
+    for row in query_images(conn):
+        if SKIP_ALREADY_SEGMENTED and row['mask_size'] is not None:
+            continue
+        original_image_path = os.path.join(GLUM_DATASET_DIR, row['name'])
+        jobs.append((original_image_path, mask_path(row['name']), row['class_id']))
+    conn.close()
+
+    if PRECOMPUTE_ONLY:
+        precompute_embeddings([job[0] for job in jobs])
+    else:
+        # start the segmentation process
+        prefetcher = EmbeddingPrefetcher(sam2_model)
+        try:
+            for i, (original_image_path, out_mask_path, class_id) in enumerate(jobs):
+                prefetcher.schedule([job[0] for job in jobs[i:]])
+                if run_segmentation_tool(original_image_path, out_mask_path, class_id, prefetcher):
+                    break
+        finally:
+            prefetcher.close()
@@ -1,30 +1,18 @@
+import hashlib
 import os
-import json
-import random
 import shutil
-import tqdm
-from pathlib import Path
+from itertools import groupby
+
+from async_writer import AsyncWriter
+from dataset_manifest import BASIC_DATASET_DIR, GLUM_DATASET_DIR, GLUM_MASKS_DIR, mask_path, open_manifest, query_images, update_manifest
 
 # Config
-LABELS_PATH = 'labels.json'
-GLUM_DATASET_DIR = 'glum_dataset'
-DATASET_IMAGES_DIR = 'basic_dataset/images'
-DATASET_MASKS_DIR = 'basic_dataset/masks'
+DATASET_IMAGES_DIR = os.path.join(BASIC_DATASET_DIR, 'images')
+DATASET_MASKS_DIR = os.path.join(BASIC_DATASET_DIR, 'masks')
 SPLITS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
 SEED = 1
-
-# Ensure reproducibility
-random.seed(SEED)
-
-# Read class names from data.yaml
-import yaml
-with open('data.yaml', 'r') as f:
-    data_yaml = yaml.safe_load(f)
-    class_names = data_yaml['names']
-
-# Read labels.json
-with open(LABELS_PATH, 'r') as f:
-    labels = json.load(f)
+LINK_THREADS = 16  # linking is metadata only, so more threads than for writes
+SKIP_DUPLICATES = True  # leave out the near-duplicates found by dedup_dataset.py
 
 # Prepare split directories
 def ensure_dirs():
@@ -34,32 +22,118 @@ def ensure_dirs():
         split_mask_dir = os.path.join(DATASET_MASKS_DIR, split)
         os.makedirs(split_mask_dir, exist_ok=True)
 
-# Split and copy images
-def split_and_copy():
-    for class_name, images in tqdm.tqdm(labels.items()):
-        random.shuffle(images)
-        n = len(images)
-
-        n_val = max(1,int(n * SPLITS['val']))
-        n_test = max(1,int(n * SPLITS['test']))
-        n_train = n - n_test - n_val
-
-        split_counts = {'train': n_train, 'val': n_val, 'test': n_test}
-        split_images = {
-            'train': images[:n_train],
-            'val': images[n_train:n_train+n_val],
-            'test': images[n_train+n_val:]
-        }
-        for split, split_imgs in split_images.items():
-            for img_rel_path in split_imgs:
-                img_name = os.path.basename(img_rel_path)
-                src_path = os.path.join(GLUM_DATASET_DIR, img_name)
-                dst_path = os.path.join(DATASET_IMAGES_DIR, split, img_name)
-                if not os.path.exists(src_path):
-                    print(f"Warning: {src_path} does not exist!")
-                    continue
-                shutil.copy2(src_path, dst_path)
+# Masks used to be saved into the split folders, move the ones glum_masks does not have yet
+def migrate_split_masks():
+    os.makedirs(GLUM_MASKS_DIR, exist_ok=True)
+    moved = 0
+    for split in SPLITS.keys():
+        split_mask_dir = os.path.join(DATASET_MASKS_DIR, split)
+        for name in sorted(os.listdir(split_mask_dir)):
+            path = os.path.join(split_mask_dir, name)
+            if name.endswith('.png') and not os.path.islink(path) and not os.path.exists(os.path.join(GLUM_MASKS_DIR, name)):
+                shutil.move(path, os.path.join(GLUM_MASKS_DIR, name))
+                moved += 1
+    return moved
+
+# Assign every photo to a split, per class
+def split_bucket(name, seed=SEED):
+    # a stable position in [0, 1) per photo, so adding or dropping one photo never moves the others
+    digest = hashlib.sha1(f"{seed}:{name}".encode()).digest()
+    return int.from_bytes(digest[:8], 'big') / 2**64
+
+def assign_splits(rows, seed=SEED):
+    assignment = {}
+    by_class = groupby(sorted(rows, key=lambda row: (row['class_id'], row['name'])), key=lambda row: row['class_id'])
+    for class_id, class_rows in by_class:
+        buckets = {row['name']: split_bucket(row['name'], seed) for row in class_rows}
+        ranked = sorted(buckets, key=buckets.get)
+        val = [name for name in ranked if buckets[name] < SPLITS['val']]
+        test = [name for name in ranked if SPLITS['val'] <= buckets[name] < SPLITS['val'] + SPLITS['test']]
+        train = [name for name in ranked if buckets[name] >= SPLITS['val'] + SPLITS['test']]
+
+        # small classes still get a val and a test photo, the ones closest to those buckets
+        if not val and train:
+            val.append(train.pop(0))
+        if not test and train:
+            test.append(train.pop(0))
+
+        for split, names in (('train', train), ('val', val), ('test', test)):
+            assignment.update(dict.fromkeys(names, split))
+    return assignment
+
+def planned_files(assignment):
+    # destination -> source for every photo and every mask that exists
+    files = {}
+    for name, split in assignment.items():
+        files[os.path.join(DATASET_IMAGES_DIR, split, name)] = os.path.join(GLUM_DATASET_DIR, name)
+        src_mask = mask_path(name)
+        if os.path.exists(src_mask):
+            files[os.path.join(DATASET_MASKS_DIR, split, os.path.basename(src_mask))] = src_mask
+    return files
+
+def existing_files():
+    files = []
+    for root in (DATASET_IMAGES_DIR, DATASET_MASKS_DIR):
+        for split in SPLITS.keys():
+            split_dir = os.path.join(root, split)
+            files.extend(os.path.join(split_dir, name) for name in os.listdir(split_dir))
+    return files
+
+def up_to_date(src, dst):
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except OSError:
+        return False  # dangling symlink or missing source
+    # copies and reflinks keep the mtime of their source
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+def source_of(path):
+    root = GLUM_MASKS_DIR if os.path.dirname(os.path.dirname(path)) == DATASET_MASKS_DIR else GLUM_DATASET_DIR
+    return os.path.join(root, os.path.basename(path))
+
+def disposable(path):
+    # symlinks never hold data, other files only go when their source exists and is the same or newer
+    if os.path.islink(path):
+        return True
+    src = source_of(path)
+    if not os.path.exists(src):
+        return False
+    return up_to_date(src, path) or os.stat(path).st_mtime_ns <= os.stat(src).st_mtime_ns
+
+def replace_file(writer, src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    writer.link_file(src, dst)
+
+# Bring the split folders in line with the assignment, touching only what differs
+def sync_splits(writer, files):
+    existing = existing_files()
+    stale = [path for path in existing if path not in files]
+    changed = [path for path in existing if path in files and not up_to_date(files[path], path)]
+    missing = [path for path in files if not os.path.lexists(path)]
+
+    # never delete the only copy of a photo or mask, e.g. one edited inside a split folder
+    kept = [path for path in stale + changed if not disposable(path)]
+    for path in kept:
+        print(f"Warning: keeping {path}, it is not a copy of {source_of(path)}")
+    stale = [path for path in stale if path not in kept]
+    changed = [path for path in changed if path not in kept]
+
+    for path in stale:
+        writer.submit(os.remove, path)
+    for path in changed + missing:
+        writer.submit(replace_file, writer, files[path], path)
+    return {'removed': len(stale), 'updated': len(changed), 'added': len(missing), 'kept': len(kept),
+            'unchanged': len(files) - len(changed) - len(missing)}
 
 if __name__ == '__main__':
     ensure_dirs()
-    split_and_copy()
\ No newline at end of file
+    print(f"Moved {migrate_split_masks()} masks into {GLUM_MASKS_DIR}")
+    conn = open_manifest()
+    files = planned_files(assign_splits(query_images(conn, unique=SKIP_DUPLICATES)))
+    with AsyncWriter(threads=LINK_THREADS) as writer:
+        print(sync_splits(writer, files))
+    update_manifest(conn)  # records the new split folders
+    conn.close()
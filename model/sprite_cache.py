@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+import cv2
+import tqdm
+
+from dataset_manifest import file_stat
+from mask_store import decode_scaled
+
+SPRITE_CACHE_DIR = os.path.join(os.path.dirname(__file__), "sprite_cache")
+SPRITE_BASE_SCALE = 5.5  # the compositor never shrinks sources less than this
+CACHE_VERSION = 2
+
+
+def read_index(bin_path, index_path):
+    # the index records the stat of the .bin it was written for, a pair from different builds is rejected
+    if not os.path.exists(index_path) or not os.path.exists(bin_path):
+        return None
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    return index if index.get('bin_stat') == file_stat(bin_path) else None
+
+def cache_paths(name):
+    return (os.path.join(SPRITE_CACHE_DIR, name + ".bin"),
+            os.path.join(SPRITE_CACHE_DIR, name + ".json"))
+
+def extract_sprite(image_path, records, class_id, base_scale=SPRITE_BASE_SCALE):
+    if not records:
+        return None
+    # the photo shows a single subject, stray pixels of another class do not count
+    record = max(records, key=lambda r: r['area'])
+    src_h, src_w = record['size']
+
+    # JPEG can be decoded straight at 1/4 resolution, the rest of the way is a small resize
+    target_w, target_h = int(src_w / base_scale), int(src_h / base_scale)
+    img = cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_4)
+    img = cv2.resize(img, (target_w, target_h), interpolation=cv2.INTER_AREA)
+
+    # only the bbox of the mask is decoded and resized
+    mask, (sx0, sy0, _, _) = decode_scaled(record, (target_h, target_w))
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    sprite = np.empty((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+    sprite[..., :3] = img[sy0 + y0:sy0 + y1, sx0 + x0:sx0 + x1]
+    sprite[..., 3] = mask[y0:y1, x0:x1] * 255
+    return sprite, class_id, [src_h, src_w]
+
+def build_sprite_cache(name, src_dir, mask_store, class_ids, base_scale=SPRITE_BASE_SCALE):
+    """Extracts the masked subjects of the photos in `class_ids` into a memory-mappable cache.
+
+    Sprites whose image and mask are unchanged since the last build are carried
+    over from the previous cache file instead of being decoded again.
+    """
+    os.makedirs(SPRITE_CACHE_DIR, exist_ok=True)
+    bin_path, index_path = cache_paths(name)
+
+    old_sources = {}
+    old_entries = {}
+    old_data = None
+    old_index = read_index(bin_path, index_path)
+    if old_index is not None and old_index.get('version') == CACHE_VERSION and old_index.get('base_scale') == base_scale:
+        old_sources = old_index['sources']
+        old_entries = {entry['name']: entry for entry in old_index['sprites']}
+        if os.path.getsize(bin_path) > 0:
+            old_data = np.memmap(bin_path, dtype=np.uint8, mode='r')
+
+    digests = {entry['name']: entry['digest'] for entry in mask_store.entries()}
+    sources = {}
+    for image_name in sorted(class_ids):
+        mask_name = os.path.splitext(image_name)[0]
+        if mask_name not in digests:
+            print(f"Warning: no mask for {image_name} in the mask store!")
+            continue
+        image_path = os.path.join(src_dir, image_name)
+        sources[image_name] = [file_stat(image_path), digests[mask_name], class_ids[image_name]]
+
+    if sources == old_sources:
+        return
+
+    entries = []
+    offset = 0
+    tmp_path = bin_path + ".tmp"
+    with open(tmp_path, 'wb') as out:
+        for image_name, stats in tqdm.tqdm(sources.items()):
+            if old_sources.get(image_name) == stats:
+                if image_name not in old_entries:
+                    continue  # the mask was empty last time as well
+                entry = dict(old_entries[image_name])
+                h, w = entry['shape']
+                data = old_data[entry['offset']:entry['offset'] + h*w*4]
+            else:
+                image_path = os.path.join(src_dir, image_name)
+                records = mask_store.records(os.path.splitext(image_name)[0])
+                extracted = extract_sprite(image_path, records, stats[2], base_scale)
+                if extracted is None:
+                    continue
+                sprite, class_id, source_shape = extracted
+                entry = {'name': image_name, 'class_id': class_id, 'shape': list(sprite.shape[:2]), 'source_shape': source_shape}
+                data = sprite
+            out.write(np.ascontiguousarray(data).tobytes())
+            entry['offset'] = offset
+            offset += entry['shape'][0] * entry['shape'][1] * 4
+            entries.append(entry)
+
+    del old_data
+    os.replace(tmp_path, bin_path)
+    with open(index_path + ".tmp", 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'base_scale': base_scale, 'bin_stat': file_stat(bin_path),
+                   'sources': sources, 'sprites': entries}, f)
+    os.replace(index_path + ".tmp", index_path)
+
+
+class SpriteCache:
+    """Read-only view of a cache written by `build_sprite_cache`."""
+
+    def __init__(self, name):
+        bin_path, index_path = cache_paths(name)
+        index = read_index(bin_path, index_path)
+        if index is None:
+            raise ValueError(f"{index_path} does not match {bin_path}, rebuild the sprite cache")
+        self.base_scale = index['base_scale']
+        self.entries = index['sprites']
+        self.data = np.memmap(bin_path, dtype=np.uint8, mode='r') if os.path.getsize(bin_path) else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sprite(self, idx):
+        """Returns the BGRA sprite, its class id and the resolution of the source photo."""
+        entry = self.entries[idx]
+        h, w = entry['shape']
+        sprite = self.data[entry['offset']:entry['offset'] + h*w*4].reshape(h, w, 4)
+        return sprite, entry['class_id'], entry['source_shape']
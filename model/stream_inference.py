@@ -0,0 +1,165 @@
+import json
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+from box_ops import box_iou
+from tflite_detector import Detector, detections_to_records, latest_model_path, load_label_names
+
+VIDEO_SOURCE = "testvideo.mp4"  # a video file, a camera index or a directory of frames
+KEYFRAME_INTERVAL = 30  # run the detector at least every this many frames
+DIFF_THRESHOLD = 6.0  # mean absolute gray level change since the last keyframe that forces a detection
+DIFF_SIZE = (160, 90)
+MATCH_IOU = 0.3
+MAX_TRACK_POINTS = 30
+
+
+def read_frames(source):
+    if isinstance(source, str) and os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is not None:
+                yield frame
+        return
+    capture = cv2.VideoCapture(source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+class FlowTracker:
+    """Carries detections between keyframes with sparse Lucas-Kanade optical flow.
+
+    Each track follows a few corner points inside its box and moves the box by
+    their median displacement. New detections take over the id of the track they
+    overlap the most.
+    """
+
+    def __init__(self, match_iou=MATCH_IOU, max_points=MAX_TRACK_POINTS):
+        self.match_iou = match_iou
+        self.max_points = max_points
+        self.next_id = 0
+        self.ids = np.zeros(0, dtype=int)
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.class_ids = np.zeros(0, dtype=int)
+        self.points = []
+        self.prev_gray = None
+
+    def reset(self, gray, boxes, scores, class_ids):
+        ids = np.full(len(boxes), -1, dtype=int)
+        if len(boxes) and len(self.boxes):
+            iou = box_iou(boxes, self.boxes)
+            iou[class_ids[:, None] != self.class_ids[None, :]] = 0
+            # greedy matching, best overlaps first
+            for flat in np.argsort(-iou, axis=None):
+                i, j = divmod(int(flat), iou.shape[1])
+                if iou[i, j] < self.match_iou:
+                    break
+                if ids[i] < 0 and self.ids[j] not in ids:
+                    ids[i] = self.ids[j]
+        for i in np.flatnonzero(ids < 0):
+            ids[i] = self.next_id
+            self.next_id += 1
+
+        self.ids = ids
+        self.boxes = boxes.astype(np.float32)
+        self.scores = scores.astype(np.float32)
+        self.class_ids = class_ids
+        self.points = [self.seed_points(gray, box) for box in self.boxes]
+        self.prev_gray = gray
+
+    def seed_points(self, gray, box):
+        x1, y1, x2, y2 = box.astype(int)
+        roi_mask = np.zeros_like(gray)
+        roi_mask[y1:y2, x1:x2] = 255
+        points = cv2.goodFeaturesToTrack(gray, self.max_points, 0.01, 5, mask=roi_mask)
+        return points if points is not None else np.zeros((0, 1, 2), dtype=np.float32)
+
+    def update(self, gray):
+        counts = [len(p) for p in self.points]
+        if sum(counts):
+            stacked = np.concatenate(self.points).astype(np.float32)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, stacked, None)
+            status = status.ravel().astype(bool)
+            start = 0
+            for i, count in enumerate(counts):
+                good = status[start:start+count]
+                if good.any():
+                    shift = np.median(moved[start:start+count][good] - stacked[start:start+count][good], axis=(0, 1))
+                    self.boxes[i] += (shift[0], shift[1], shift[0], shift[1])
+                self.points[i] = moved[start:start+count][good]
+                start += count
+        self.prev_gray = gray
+        return self.ids, self.boxes, self.scores, self.class_ids
+
+
+def summarize(durations):
+    values = np.array(durations) * 1000
+    if len(values) == 0:
+        return {"count": 0}
+    return {"count": len(values), "mean_ms": round(float(values.mean()), 3),
+            **{f"p{q}_ms": round(float(np.percentile(values, q)), 3) for q in (50, 90, 95, 99)}}
+
+def run_stream(detector, source, out=sys.stdout, keyframe_interval=KEYFRAME_INTERVAL, diff_threshold=DIFF_THRESHOLD):
+    """Detects on keyframes, tracks in between and returns per-stage latency statistics."""
+    tracker = FlowTracker()
+    label_names = load_label_names()
+    stages = {"read": [], "diff": [], "detect": [], "track": []}
+    key_small = None
+    since_key = 0
+    frames = 0
+    start = time.perf_counter()
+
+    frame_iter = iter(read_frames(source))
+    while True:
+        t0 = time.perf_counter()
+        frame = next(frame_iter, None)
+        if frame is None:
+            break
+        t1 = time.perf_counter()
+        stages["read"].append(t1 - t0)
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, DIFF_SIZE, interpolation=cv2.INTER_AREA)
+        is_key = (key_small is None or since_key >= keyframe_interval or
+                  float(cv2.absdiff(small, key_small).mean()) > diff_threshold)
+        t2 = time.perf_counter()
+        stages["diff"].append(t2 - t1)
+
+        if is_key:
+            boxes, scores, class_ids = detector.detect(frame)
+            tracker.reset(gray, boxes, scores, class_ids)
+            key_small = small
+            since_key = 0
+            stages["detect"].append(time.perf_counter() - t2)
+        else:
+            tracker.update(gray)
+            since_key += 1
+            stages["track"].append(time.perf_counter() - t2)
+
+        objects = detections_to_records(tracker.boxes, tracker.scores, tracker.class_ids, label_names)
+        for obj, track_id in zip(objects, tracker.ids.tolist()):
+            obj["track_id"] = track_id
+        out.write(json.dumps({"frame": frames, "keyframe": is_key, "detections": objects}) + "\n")
+        frames += 1
+
+    elapsed = time.perf_counter() - start
+    return {
+        "frames": frames,
+        "keyframes": len(stages["detect"]),
+        "effective_fps": round(frames / elapsed, 2) if elapsed > 0 else 0.0,
+        "stages": {name: summarize(durations) for name, durations in stages.items()},
+    }
+
+
+if __name__ == "__main__":
+    report = run_stream(Detector(latest_model_path()), VIDEO_SOURCE)
+    print(json.dumps(report, indent=2), file=sys.stderr)
@@ -0,0 +1,117 @@
+import os
+import numpy as np
+import cv2
+
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.segment import SegmentationTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel
+
+from create_mixed_dataset import build_sprites, compose_mix, load_sprites, render_shape
+
+STREAM_SPLIT = "train"
+MIXES_PER_EPOCH = None  # one mix per sprite, like the pre-rendered dataset
+
+
+class StreamingMixDataset(YOLODataset):
+    """Training dataset that composes a fresh mix for every sample it hands out.
+
+    Nothing is read from `img_path`, the images and polygon labels come straight
+    from `compose_mix` inside the dataloader workers.
+    """
+
+    def __init__(self, *args, mix_split=STREAM_SPLIT, mixes_per_epoch=MIXES_PER_EPOCH, **kwargs):
+        self.mix_split = mix_split
+        self.mixes_per_epoch = mixes_per_epoch
+        self.rng_pid = None
+        self.generator = None
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        build_sprites(self.mix_split)
+        count = self.mixes_per_epoch or len(load_sprites(self.mix_split))
+        return [f"mix_{mix_idx:06d}.jpg" for mix_idx in range(count)]
+
+    def get_labels(self):
+        shape = render_shape()
+        return [self.empty_label(im_file, shape) for im_file in self.im_files]
+
+    def empty_label(self, im_file, shape):
+        return {
+            "im_file": im_file,
+            "shape": shape,
+            "cls": np.zeros((0, 1), dtype=np.float32),
+            "bboxes": np.zeros((0, 4), dtype=np.float32),
+            "segments": [],
+            "keypoints": None,
+            "normalized": True,
+            "bbox_format": "xywh",
+        }
+
+    def rng(self):
+        # dataloader workers are forked from the same state, reseed once per process
+        if self.rng_pid != os.getpid():
+            self.rng_pid = os.getpid()
+            self.generator = np.random.default_rng()
+        return self.generator
+
+    def get_image_and_label(self, index):
+        img, instances, _ = compose_mix(self.mix_split, load_sprites(self.mix_split), self.rng(), render_shape())
+
+        label = self.empty_label(self.im_files[index], img.shape[:2])
+        label.pop("shape")
+        if instances:
+            segments = [polygon.astype(np.float32) for _, polygon in instances]
+            mins = np.array([segment.min(axis=0) for segment in segments])
+            maxs = np.array([segment.max(axis=0) for segment in segments])
+            label["cls"] = np.array([[class_id] for class_id, _ in instances], dtype=np.float32)
+            label["bboxes"] = np.concatenate(((mins + maxs) / 2, maxs - mins), axis=1).astype(np.float32)
+            label["segments"] = segments
+
+        # same resize as BaseDataset.load_image, a no-op when mixes are rendered at imgsz
+        h0, w0 = img.shape[:2]
+        r = self.imgsz / max(h0, w0)
+        if r != 1:
+            w, h = (min(int(np.ceil(w0 * r)), self.imgsz), min(int(np.ceil(h0 * r)), self.imgsz))
+            img = cv2.resize(img, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        # Mosaic draws its extra images from the buffer that load_image fills, the images themselves are not kept
+        if self.augment:
+            self.buffer.append(index)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+
+        label["img"], label["ori_shape"], label["resized_shape"] = img, (h0, w0), img.shape[:2]
+        label["ratio_pad"] = (label["resized_shape"][0] / h0, label["resized_shape"][1] / w0)
+        if self.rect:
+            label["rect_shape"] = self.batch_shapes[self.batch[index]]
+        return self.update_labels_info(label)
+
+
+class StreamingMixTrainer(SegmentationTrainer):
+    """Segmentation trainer whose train split is composed on the fly."""
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        if mode != "train":
+            return super().build_dataset(img_path, mode, batch)
+        gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        return StreamingMixDataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=True,
+            hyp=self.args,
+            rect=False,
+            cache=False,
+            single_cls=self.args.single_cls or False,
+            stride=gs,
+            pad=0.0,
+            prefix=colorstr(f"{mode}: "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction,
+        )
+
+    def plot_training_labels(self):
+        pass  # labels only exist once a batch has been composed
@@ -0,0 +1,178 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None  # the pre- and post-processing helpers work without it
+
+from mask_decoder import decode_masks, format_masks
+
+RUNS_PATH   = os.path.join(os.path.dirname(__file__), "gloomhaven-monster-recognizer")
+TEST_DIR    = os.path.join(os.path.dirname(__file__), "dataset", "images", "test")
+LABELS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "app", "gloomhaven_monster_recognizer_app", "assets", "models", "labels.txt")
+
+CONF_THRESHOLD = 0.5
+PAD_VALUE = 114
+NUM_THREADS = 2  # threads of a single interpreter
+WORKERS = 4  # interpreters running side by side in run_directory
+
+
+def latest_model_path(runs_path=RUNS_PATH):
+    runs = [ rn for rn in os.listdir(runs_path)]
+    latest_run = max(runs, key=lambda x: os.path.getmtime(os.path.join(runs_path, x)))
+    return os.path.join(runs_path, latest_run, "weights", "best_saved_model", "best_float32.tflite")
+
+def load_label_names(path=LABELS_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def letterbox_params(shape, new_shape):
+    # Same math as the ultralytics letterbox, only scales down
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1], 1.0)
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw = (new_shape[1] - new_unpad[0]) / 2
+    dh = (new_shape[0] - new_unpad[1]) / 2
+    return r, dw, dh, new_unpad
+
+def scale_boxes(boxes, r, dw, dh, input_shape, img_shape):
+    """Maps normalized (x1, y1, x2, y2) model boxes back to clipped pixels of the original image."""
+    boxes = boxes * (input_shape[1], input_shape[0], input_shape[1], input_shape[0])
+    boxes -= (dw, dh, dw, dh)
+    boxes /= r
+    np.clip(boxes[:, 0::2], 0, img_shape[1], out=boxes[:, 0::2])
+    np.clip(boxes[:, 1::2], 0, img_shape[0], out=boxes[:, 1::2])
+    return boxes
+
+def filter_detections(det, conf_threshold):
+    # rows are x1, y1, x2, y2, conf, class_id followed by mask coefficients for seg models
+    return det[det[:, 4] > conf_threshold]
+
+def detections_to_records(boxes, scores, class_ids, label_names=None):
+    objects = []
+    for box, score, class_id in zip(boxes.astype(int).tolist(), scores.tolist(), class_ids.tolist()):
+        obj = {"box": box, "conf": round(score, 4), "class_id": class_id}
+        if label_names is not None and class_id < len(label_names):
+            obj["label"] = label_names[class_id]
+        objects.append(obj)
+    return objects
+
+def detections_to_json(name, boxes, scores, class_ids, label_names=None):
+    return json.dumps({"image": name, "detections": detections_to_records(boxes, scores, class_ids, label_names)})
+
+
+class Detector:
+    """Loads a TFLite model once and runs letterboxed detection on BGR images.
+
+    The letterbox canvas and the input tensor are allocated once and reused, so a
+    Detector must not be shared between threads.
+    """
+
+    def __init__(self, model_path, num_threads=NUM_THREADS, conf_threshold=CONF_THRESHOLD):
+        if tf is None:
+            raise ImportError("Detector needs tensorflow for the TFLite interpreter")
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.conf_threshold = conf_threshold
+
+        _, h, w, _ = self.input_details[0]['shape']
+        self.input_shape = (int(h), int(w))
+        self.canvas = np.full((h, w, 3), PAD_VALUE, dtype=np.uint8)
+        self.rgb = np.empty((h, w, 3), dtype=np.uint8)
+        self.input = np.empty((1, h, w, 3), dtype=self.input_details[0]['dtype'])
+        self.last_content = None
+
+        self.det_output = next(o for o in self.output_details if len(o['shape']) == 3)
+        # segmentation exports also output the (1, h, w, n) mask prototypes
+        self.proto_output = next((o for o in self.output_details if len(o['shape']) == 4), None)
+
+    def preprocess(self, img):
+        r, dw, dh, new_unpad = letterbox_params(img.shape[:2], self.input_shape)
+        top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+        content = (top, left, new_unpad[1], new_unpad[0])
+
+        # only repaint the padding when the content area moved
+        if content != self.last_content:
+            self.canvas[:] = PAD_VALUE
+            self.last_content = content
+        view = self.canvas[top:top+new_unpad[1], left:left+new_unpad[0]]
+        if img.shape[1::-1] != new_unpad:
+            view[:] = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+        else:
+            view[:] = img
+
+        cv2.cvtColor(self.canvas, cv2.COLOR_BGR2RGB, dst=self.rgb)
+        if self.input.dtype == np.float32:
+            np.multiply(self.rgb, np.float32(1 / 255), out=self.input[0])
+        else:
+            # fully quantized models take integer input
+            scale, zero_point = self.input_details[0]['quantization']
+            info = np.iinfo(self.input.dtype)
+            self.input[0] = np.clip(np.round(self.rgb / (255 * scale) + zero_point), info.min, info.max)
+        return r, dw, dh
+
+    def output(self, details):
+        tensor = self.interpreter.get_tensor(details['index'])[0]
+        if np.issubdtype(tensor.dtype, np.integer):
+            scale, zero_point = details['quantization']
+            tensor = (tensor.astype(np.float32) - zero_point) * scale
+        return tensor
+
+    def invoke(self):
+        self.interpreter.set_tensor(self.input_details[0]['index'], self.input)
+        self.interpreter.invoke()
+        return self.output(self.det_output)
+
+    def detect(self, img):
+        """Returns (boxes, scores, class_ids) with boxes as x1, y1, x2, y2 in image pixels."""
+        r, dw, dh = self.preprocess(img)
+        det = filter_detections(self.invoke(), self.conf_threshold)
+        boxes = scale_boxes(det[:, :4], r, dw, dh, self.input_shape, img.shape[:2])
+        return boxes, det[:, 4], det[:, 5].astype(int)
+
+    def detect_masks(self, img, mask_format="bitmap"):
+        """Like `detect`, plus one instance mask per detection in `mask_format`."""
+        if self.proto_output is None:
+            raise ValueError("The model has no mask prototype output")
+        r, dw, dh = self.preprocess(img)
+        det = filter_detections(self.invoke(), self.conf_threshold)
+        boxes = scale_boxes(det[:, :4], r, dw, dh, self.input_shape, img.shape[:2])
+        int_boxes = boxes.astype(int)
+
+        protos = self.output(self.proto_output)
+        masks = decode_masks(det[:, 6:], protos, int_boxes, r, dw, dh, self.input_shape)
+        masks = format_masks(masks, int_boxes, img.shape[:2], mask_format)
+        return boxes, det[:, 4], det[:, 5].astype(int), masks
+
+
+def run_directory(model_path, image_dir, out=sys.stdout, workers=WORKERS, num_threads=NUM_THREADS):
+    """Streams detections for every image of `image_dir` to `out` as JSON lines."""
+    local = threading.local()
+    label_names = load_label_names()
+
+    def process(name):
+        if not hasattr(local, 'detector'):
+            local.detector = Detector(model_path, num_threads=num_threads)
+        img = cv2.imread(os.path.join(image_dir, name))
+        if img is None:
+            return json.dumps({"image": name, "error": "could not read image"})
+        return detections_to_json(name, *local.detector.detect(img), label_names)
+
+    names = sorted(os.listdir(image_dir))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for line in executor.map(process, names):
+            out.write(line + "\n")
+            out.flush()
+
+
+if __name__ == "__main__":
+    run_directory(latest_model_path(), TEST_DIR)
@@ -0,0 +1,86 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+from box_ops import batched_nms, weighted_box_fusion
+from tflite_detector import NUM_THREADS, Detector, latest_model_path
+
+TILE_SIZE = 640
+TILE_OVERLAP = 0.2
+WORKERS = 4
+MERGE = "nms"  # "nms" or "wbf"
+IOU_THRESHOLD = 0.5
+INCLUDE_FULL_IMAGE = True  # also run the whole letterboxed image for standees larger than a tile
+
+
+def tile_origins(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = max(int(tile * (1 - overlap)), 1)
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+class TiledDetector:
+    """Runs a Detector over overlapping tiles of a large photo and merges the results.
+
+    Tiles are spread over a pool of interpreters, every tile goes through the
+    regular letterbox of the Detector and its boxes are shifted by the tile origin.
+    """
+
+    def __init__(self, model_path, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, workers=WORKERS,
+                 num_threads=NUM_THREADS, merge=MERGE, iou_threshold=IOU_THRESHOLD,
+                 include_full_image=INCLUDE_FULL_IMAGE):
+        if merge not in ("nms", "wbf"):
+            raise ValueError(f"Unknown merge method {merge}")
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.merge = merge
+        self.iou_threshold = iou_threshold
+        self.include_full_image = include_full_image
+        self.detectors = queue.Queue()
+        for _ in range(workers):
+            self.detectors.put(Detector(model_path, num_threads=num_threads))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def tiles(self, img_shape):
+        h, w = img_shape[:2]
+        tiles = [(x0, y0, self.tile_size, self.tile_size)
+                 for y0 in tile_origins(h, self.tile_size, self.overlap)
+                 for x0 in tile_origins(w, self.tile_size, self.overlap)]
+        if self.include_full_image and len(tiles) > 1:
+            tiles.append((0, 0, w, h))
+        return tiles
+
+    def detect_tile(self, img, tile):
+        x0, y0, tw, th = tile
+        detector = self.detectors.get()
+        try:
+            boxes, scores, class_ids = detector.detect(img[y0:y0+th, x0:x0+tw])
+        finally:
+            self.detectors.put(detector)
+        return boxes + (x0, y0, x0, y0), scores, class_ids
+
+    def detect(self, img):
+        """Returns merged (boxes, scores, class_ids) in pixels of the full image."""
+        results = list(self.executor.map(lambda tile: self.detect_tile(img, tile), self.tiles(img.shape)))
+        boxes = np.concatenate([r[0] for r in results])
+        scores = np.concatenate([r[1] for r in results])
+        class_ids = np.concatenate([r[2] for r in results])
+
+        if self.merge == "wbf":
+            return weighted_box_fusion(boxes, scores, class_ids, self.iou_threshold)
+        keep = batched_nms(boxes, scores, class_ids, self.iou_threshold)
+        return boxes[keep], scores[keep], class_ids[keep]
+
+
+if __name__ == "__main__":
+    img = cv2.imread("testimg.jpg")
+    detector = TiledDetector(latest_model_path())
+    boxes, scores, class_ids = detector.detect(img)
+    detector.close()
+    for (x1, y1, x2, y2), conf, class_id in zip(boxes.astype(int), scores, class_ids):
+        print(f"Box: x={x1}, y={y1}, x2={x2}, y2={y2}, conf={conf:.2f}, class={class_id}")
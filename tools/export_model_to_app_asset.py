@@ -1,35 +1,225 @@
+import hashlib
+import multiprocessing
 import os
+import random
 import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import ultralytics
 import json
+import cv2
+import numpy as np
+import yaml
 
 RUNS_PATH  = os.path.join( os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)), "model", "gloomhaven-monster-recognizer")
 TARGET_DIR = os.path.join( os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)), "app", "gloomhaven_monster_recognizer_app", "assets", "models")
 LABELS_DIR = os.path.join( os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)), "model")
+DATASET_DIR = os.path.join(LABELS_DIR, "dataset")
+EXPORT_CACHE_DIR = os.path.join(LABELS_DIR, "export_cache")
+
+sys.path.insert(0, LABELS_DIR)
+from evaluate_model import LABELS_DIR as TEST_LABELS_DIR, TEST_DIR, evaluate, file_fingerprint
+from tflite_detector import Detector
+
+EXPORT_JOBS = {
+    "tflite": {"format": "tflite", "nms": True, "int8": True},
+    "coreml": {"format": "coreml", "nms": True},
+}
+TFLITE_VARIANTS = ["float32", "float16", "int8"]
+CALIBRATION_IMAGES = 200  # images sampled from the val split for int8 calibration
+ACCURACY_FLOOR = 0.97  # a variant must keep this share of the float32 mAP50-95 to be shipped
+BENCHMARK_RUNS = 50
+BENCHMARK_THREADS = 4
+SEED = 1
+
+
+def calibration_images():
+    val_dir = os.path.join(DATASET_DIR, "images", "val")
+    images = sorted(os.listdir(val_dir))
+    random.Random(SEED).shuffle(images)
+    return [os.path.join(val_dir, image) for image in images[:CALIBRATION_IMAGES]]
+
+def test_split_digest():
+    # the variant comparison evaluates on the test split, so its report is only valid for this state
+    entries = [[name, file_fingerprint(os.path.join(folder, name))]
+               for folder in (TEST_DIR, TEST_LABELS_DIR) for name in sorted(os.listdir(folder))]
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+def write_calibration_config(weights_dir):
+    # the int8 export calibrates on the val split of this config
+    with open(os.path.join(LABELS_DIR, 'data.yaml'), 'r') as f:
+        data_yaml = yaml.safe_load(f)
+
+    list_path = os.path.join(weights_dir, "calibration_images.txt")
+    with open(list_path, 'w') as f:
+        for image in calibration_images():
+            f.write(image + '\n')
+
+    data_yaml.update({'path': DATASET_DIR, 'train': list_path, 'val': list_path})
+    data_yaml.pop('test', None)
+    config_path = os.path.join(weights_dir, "calibration.yaml")
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(data_yaml, f)
+    return config_path
+
+def benchmark_latency(model_path, img, runs=BENCHMARK_RUNS):
+    detector = Detector(model_path, num_threads=BENCHMARK_THREADS)
+    detector.detect(img)  # warm up
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        detector.detect(img)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000)
+
+def compare_variants(weights_dir):
+    val_dir = os.path.join(DATASET_DIR, "images", "val")
+    img = cv2.imread(os.path.join(val_dir, sorted(os.listdir(val_dir))[0]))
+
+    rows = []
+    for variant in TFLITE_VARIANTS:
+        path = os.path.join(weights_dir, "best_saved_model", f"best_{variant}.tflite")
+        if not os.path.exists(path):
+            print(f"Warning: {path} does not exist!")
+            continue
+        accuracy = evaluate(path, results_path=None)
+        rows.append({
+            "variant": variant,
+            "path": path,
+            "size_mb": round(os.path.getsize(path) / 2**20, 2),
+            "latency_ms": round(benchmark_latency(path, img), 2),
+            "mAP50": round(accuracy["mAP50"], 4),
+            "mAP50-95": round(accuracy["mAP50-95"], 4),
+        })
+    return rows
+
+def write_if_changed(path, text):
+    # unchanged files keep their mtime, so an unchanged run touches nothing
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return False
+    with open(path, 'w') as f:
+        f.write(text)
+    return True
+
+def write_report(rows, selected, weights_dir, test_digest):
+    lines = ["| variant | size (MB) | CPU latency (ms) | mAP50 | mAP50-95 |",
+             "|---|---|---|---|---|"]
+    for row in rows:
+        marker = " (shipped)" if row is selected else ""
+        lines.append(f"| {row['variant']}{marker} | {row['size_mb']} | {row['latency_ms']} | {row['mAP50']} | {row['mAP50-95']} |")
+    report = "\n".join(lines)
+    write_if_changed(os.path.join(weights_dir, "export_report.md"), report + "\n")
+    write_if_changed(os.path.join(weights_dir, "export_report.json"),
+                     json.dumps({"accuracy_floor": ACCURACY_FLOOR, "test_split": test_digest, "variants": rows,
+                                 "selected": selected["variant"]}, indent=2))
+    print(report)
+
+def select_variant(rows):
+    # the fastest variant that keeps enough of the float32 accuracy
+    reference = next((row for row in rows if row["variant"] == "float32"), None)
+    if reference is None:
+        return None
+    floor = ACCURACY_FLOOR * reference["mAP50-95"]
+    candidates = [row for row in rows if row["mAP50-95"] >= floor]
+    return min(candidates, key=lambda row: row["latency_ms"])
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def job_hash(weights_hash, name, options, labels_text):
+    # everything that changes the exported files
+    key = json.dumps({"weights": weights_hash, "job": name, "options": options, "labels": labels_text,
+                      "ultralytics": ultralytics.__version__}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def export_job(job_dir, weights_path, options):
+    # runs in its own process and directory, so formats never share a working folder
+    os.makedirs(job_dir, exist_ok=True)
+    job_weights = os.path.join(job_dir, "best.pt")
+    shutil.copy(weights_path, job_weights)
+    if options.pop("calibrate", False):
+        options["data"] = write_calibration_config(job_dir)
+    ultralytics.YOLO(job_weights).export(**options)
+    open(os.path.join(job_dir, ".complete"), 'w').close()
+
+def update_asset(src, name, inputs_hash, manifest):
+    dst = os.path.join(TARGET_DIR, name)
+    sha = file_sha256(src)
+    if not os.path.exists(dst) or file_sha256(dst) != sha:
+        shutil.copy(src, dst)
+    manifest["assets"][name] = {"sha256": sha, "inputs_hash": inputs_hash}
 
 def main():
 
     with open(os.path.join(LABELS_DIR, 'labels.json'), 'r') as file:
         labels = json.load(file)
+    labels_text = "".join(label + '\n' for label in map(lambda e : e['name'], labels))
 
-    with open(os.path.join(TARGET_DIR, 'labels.txt'), 'w') as file:
-        for label in map(lambda e : e['name'], labels):
-            file.write(label + '\n')
+    write_if_changed(os.path.join(TARGET_DIR, 'labels.txt'), labels_text)
 
     runs = [ rn for rn in os.listdir(RUNS_PATH)]
 
     # get the latest run
     latest_run = max(runs, key=lambda x: os.path.getmtime(os.path.join(RUNS_PATH, x)))
+    weights_path = os.path.join(RUNS_PATH, latest_run, "weights", "best.pt")
+    weights_hash = file_sha256(weights_path)
+
+    # export every format in its own content-addressed cache folder, reusing finished ones
+    job_dirs = {}
+    pending = {}
+    for name, options in EXPORT_JOBS.items():
+        job_options = dict(options, calibrate=True) if name == "tflite" else dict(options)
+        hash_options = dict(job_options, calibration=[os.path.basename(path) for path in calibration_images()]) if name == "tflite" else job_options
+        job_dirs[name] = os.path.join(EXPORT_CACHE_DIR, f"{name}-{job_hash(weights_hash, name, hash_options, labels_text)[:16]}")
+        if not os.path.exists(os.path.join(job_dirs[name], ".complete")):
+            pending[name] = job_options
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=len(pending), mp_context=multiprocessing.get_context("spawn")) as executor:
+            jobs = [executor.submit(export_job, job_dirs[name], weights_path, options) for name, options in pending.items()]
+            for job in jobs:
+                job.result()
 
-    # export the model to the app asset
-    model = ultralytics.YOLO(os.path.join(RUNS_PATH, latest_run, "weights", "best.pt"))
-    model.export(format="tflite", nms=True)
-    model.export(format="coreml", nms=True)
+    # the int8 export also writes the float32 and float16 models, ship the best one
+    tflite_dir = job_dirs["tflite"]
+    # measurements are reused while the test split is unchanged, the selection is made again on every run
+    report_path = os.path.join(tflite_dir, "export_report.json")
+    test_digest = test_split_digest()
+    rows = None
+    if os.path.exists(report_path):
+        with open(report_path, 'r') as f:
+            report = json.load(f)
+        if report.get("test_split") == test_digest:
+            rows = [row for row in report["variants"] if row["variant"] in TFLITE_VARIANTS]
+            if {row["variant"] for row in rows} != set(TFLITE_VARIANTS):
+                rows = None
+    if rows is None:
+        rows = compare_variants(tflite_dir)
+    selected = select_variant(rows)
+    if selected is None:
+        # shipping the old TFLite model next to new weights would leave the app inconsistent
+        raise RuntimeError(f"No TFLite variant to ship, the float32 model is missing in {tflite_dir}")
+    write_report(rows, selected, tflite_dir, test_digest)
+
+    manifest = {"weights": os.path.relpath(weights_path, RUNS_PATH), "weights_sha256": weights_hash, "assets": {}}
+    manifest_path = os.path.join(TARGET_DIR, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest["assets"] = json.load(f).get("assets", {})
 
     # rename and move models to assets
-    shutil.copy(os.path.join(RUNS_PATH, latest_run, "weights", "best_saved_model", "best_float32.tflite"), os.path.join(TARGET_DIR, "gmr-yolo11s-seg.tflite"))
-    shutil.copy(os.path.join(RUNS_PATH, latest_run, "weights", "best.mlpackage", "Data", "com.apple.CoreML", "model.mlmodel"), os.path.join(TARGET_DIR, "gmr-yolo11s-seg.mlmodel"))
+    update_asset(selected["path"], "gmr-yolo11s-seg.tflite", os.path.basename(tflite_dir), manifest)
+    manifest["assets"]["gmr-yolo11s-seg.tflite"].update(variant=selected["variant"], weights_sha256=weights_hash)
+    update_asset(os.path.join(job_dirs["coreml"], "best.mlpackage", "Data", "com.apple.CoreML", "model.mlmodel"),
+                 "gmr-yolo11s-seg.mlmodel", os.path.basename(job_dirs["coreml"]), manifest)
+    manifest["assets"]["gmr-yolo11s-seg.mlmodel"]["weights_sha256"] = weights_hash
+
+    write_if_changed(manifest_path, json.dumps(manifest, indent=2))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()